@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import asyncio
+import functools
+import dotenv
+
+
+dotenv.load_dotenv()
+
+ALERT_STATE_PATH: str = os.getenv("ALERT_STATE_PATH", "data/alerts.db")
+# How far past the last alerted value an indicator has to move before alerting again
+ALERT_ESCALATION_STEP: float = float(os.getenv("ALERT_ESCALATION_STEP", "5"))
+# Seconds the first alert of a batch waits for others before it is sent
+ALERT_FLUSH_SECONDS: float = float(os.getenv("ALERT_FLUSH_SECONDS", "2"))
+
+NEW = "New"
+ESCALATED = "Escalated"
+EXIT = "Exit"
+
+
+# Persistent per (ticker, rule) alert state, so only changes are alerted on between runs.
+# An alert only changes the state once Discord has accepted it (see `delivered`), so a failed delivery is sent again
+class AlertState:
+    def __init__(self, path: str = ALERT_STATE_PATH, escalation_step: float = ALERT_ESCALATION_STEP):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.escalation_step = escalation_step
+        self.opened_at = time.time()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS alert_state ("
+            "ticker TEXT NOT NULL, rule TEXT NOT NULL, value REAL, alerted_at REAL, seen_at REAL, "
+            "PRIMARY KEY (ticker, rule))"
+        )
+        self.active = {
+            (ticker, rule): value
+            for ticker, rule, value in self.connection.execute("SELECT ticker, rule, value FROM alert_state")
+        }
+
+    def observe(self, ticker: str, rule: str, value: float, matched: bool, direction: int = 0) -> str:
+        """Evaluates one result and returns NEW, ESCALATED, EXIT or None when nothing changed.
+        `direction` is -1 when lower values are more extreme (oversold), 1 when higher are, 0 to never escalate.
+        Only marks an active alert as seen, the event itself is recorded by `delivered`
+        """
+        key = (ticker, rule)
+        if key in self.active:
+            self.connection.execute(
+                "UPDATE alert_state SET seen_at = ? WHERE ticker = ? AND rule = ?", (time.time(), *key)
+            )
+        if not matched:
+            return EXIT if key in self.active else None
+        if key not in self.active:
+            return NEW
+        if direction and value is not None and self.active[key] is not None \
+                and (value - self.active[key]) * direction >= self.escalation_step:
+            return ESCALATED
+        return None
+
+    def delivered(self, alerts: list):
+        """Records alerts Discord has accepted, as (ticker, value, rule, timestamp, indicator, event) tuples.
+        Usually called by the delivery queue after the scan has closed the state, so it opens its own connection then
+        """
+        connection = self.connection if self.connection is not None else sqlite3.connect(self.path)
+        now = time.time()
+        try:
+            for ticker, value, rule, _, _, event in alerts:
+                key = (ticker, rule)
+                if event == EXIT:
+                    self.active.pop(key, None)
+                    connection.execute("DELETE FROM alert_state WHERE ticker = ? AND rule = ?", key)
+                else:
+                    self.active[key] = value
+                    connection.execute(
+                        "INSERT OR REPLACE INTO alert_state (ticker, rule, value, alerted_at, seen_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (ticker, rule, value, now, now),
+                    )
+            connection.commit()
+        finally:
+            if connection is not self.connection:
+                connection.close()
+
+    def prune(self, keep: set = ()) -> int:
+        """Drops active alerts not observed since the state was opened, e.g. tickers that left the universe
+        or rules that were removed. Tickers in `keep` (no data this run) are left alone. Returns the count
+        """
+        stale = [
+            (ticker, rule)
+            for ticker, rule in self.connection.execute(
+                "SELECT ticker, rule FROM alert_state WHERE seen_at IS NULL OR seen_at < ?", (self.opened_at,)
+            )
+            if ticker not in keep
+        ]
+        for key in stale:
+            self.active.pop(key, None)
+        self.connection.executemany("DELETE FROM alert_state WHERE ticker = ? AND rule = ?", stale)
+        return len(stale)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def rollback(self):
+        """Closes without keeping this run's seen marks and pruning, for a scan that failed part way"""
+        self.connection.rollback()
+        self.connection.close()
+        self.connection = None
+
+
+# Collects alerts as they are produced and sends them in small batches,
+# so the first alerts go out while the rest of the universe is still being scanned
+class AlertBatcher:
+    def __init__(self, send, flush_seconds: float = ALERT_FLUSH_SECONDS, batch_size: int = 25, on_delivered=None):
+        """`send(batch, on_delivered)` queues a batch, `on_delivered(batch)` is called once it was accepted"""
+        self.send = send
+        self.on_delivered = on_delivered
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.pending = []
+        self.sent = 0
+        self.timer: asyncio.Task = None
+        self.waiting = False
+
+    async def add(self, alert: tuple):
+        self.pending.append(alert)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self.timer is None or self.timer.done():
+            self.waiting = True
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_seconds)
+        self.waiting = False
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            self.sent += len(batch)
+            if self.on_delivered is None:
+                await self.send(batch)
+            else:
+                await self.send(batch, functools.partial(self.on_delivered, batch))
+
+    async def close(self):
+        if self.timer is not None:
+            # Only cancel a timer that is still sleeping, never a send in progress
+            if self.waiting:
+                self.timer.cancel()
+            await asyncio.gather(self.timer, return_exceptions=True)
+        await self.flush()
+        if not self.sent:
+            print("No new alerts to send.")
@@ -0,0 +1,208 @@
+import os
+import asyncio
+import numpy as np
+import dotenv
+from fetcher import POLYGON_BASE_URL
+from metrics import timed
+from sleeping import is_trading_day
+from datetime import date, datetime, timedelta
+
+
+dotenv.load_dotenv()
+
+POLYGON_API_KEY: str = os.getenv("POLYGON_API_KEY")
+BAR_STORE_PATH: str = os.getenv("BAR_STORE_PATH", "data/daily_bars.npz")
+# Number of trading days kept in the store, enough for Wilder smoothing to settle
+BAR_HISTORY_DAYS: int = int(os.getenv("BAR_HISTORY_DAYS", "60"))
+
+GROUPED_DAILY_URL = POLYGON_BASE_URL + "/v2/aggs/grouped/locale/us/market/stocks/{day}"
+SPLITS_URL = POLYGON_BASE_URL + "/v3/reference/splits"
+
+
+# Local store of daily closes for the whole market, one grouped-daily call per trading day
+class BarStore:
+    def __init__(self, path: str = BAR_STORE_PATH, history_days: int = BAR_HISTORY_DAYS):
+        self.path = path
+        self.history_days = history_days
+        self.closes: dict[str, dict[str, float]] = {}  # "YYYY-MM-DD" -> {ticker: close}
+        # Last date checked for splits, every stored close is adjusted up to this day
+        self.splits_checked: str = ""
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path, allow_pickle=False) as data:
+            days = [str(d) for d in data["days"]]
+            tickers = [str(t) for t in data["tickers"]]
+            matrix = data["closes"]
+            # Stores saved before splits were tracked were last filled no earlier than their newest day
+            if "splits_checked" in data.files:
+                self.splits_checked = str(data["splits_checked"])
+            else:
+                self.splits_checked = max(days, default="")
+        for j, day in enumerate(days):
+            column = matrix[:, j]
+            valid = ~np.isnan(column)
+            self.closes[day] = {tickers[i]: float(column[i]) for i in np.flatnonzero(valid)}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        days = self.trading_days()
+        tickers = sorted({ticker for day in days for ticker in self.closes[day]})
+        _, matrix = self.close_matrix(tickers)
+        np.savez_compressed(
+            self.path,
+            days=np.array(days, dtype=str),
+            tickers=np.array(tickers, dtype=str),
+            closes=matrix,
+            splits_checked=np.array(self.splits_checked, dtype=str),
+        )
+
+    def trading_days(self) -> list:
+        return sorted(self.closes)
+
+    def _missing_days(self, until: date) -> list:
+        """Returns the trading days up to `until` that are needed to hold `history_days` of them
+        and are not in the store yet, newest first
+        """
+        missing = []
+        have = 0
+        day = until
+        # Bounded look-back so a long run of closed days cannot loop forever
+        for _ in range(self.history_days * 2 + 14):
+            if have >= self.history_days:
+                break
+            key = day.isoformat()
+            if is_trading_day(day):
+                if key not in self.closes:
+                    missing.append(key)
+                have += 1
+            day -= timedelta(days=1)
+        return missing
+
+    async def _fetch_day(self, scheduler, day: str):
+        url = f"{GROUPED_DAILY_URL.format(day=day)}?adjusted=true&apiKey={POLYGON_API_KEY}"
+        status, data = await scheduler.get(url)
+        if status != 200 or data is None:
+            print(f"Error fetching grouped bars for {day}: {status}")
+            return day, None
+        results = data.get("results") or []
+        return day, {row["T"]: float(row["c"]) for row in results if "T" in row and "c" in row}
+
+    async def _fetch_splits(self, scheduler, since: str, until: str) -> list:
+        """Splits executed after `since` up to `until`, None when the check failed"""
+        url = (
+            f"{SPLITS_URL}?execution_date.gt={since}&execution_date.lte={until}"
+            f"&limit=1000&apiKey={POLYGON_API_KEY}"
+        )
+        splits = []
+        while url:
+            status, data = await scheduler.get(url)
+            if status != 200 or data is None:
+                print(f"Error fetching splits since {since}: {status}")
+                return None
+            splits.extend(data.get("results") or [])
+            url = data.get("next_url")
+            if url:
+                url += f"&apiKey={POLYGON_API_KEY}"
+        return splits
+
+    def apply_splits(self, splits: list) -> int:
+        """Rescales the stored closes before each split to the post-split price scale,
+        returns the number of tickers touched
+        """
+        touched = set()
+        for split in splits:
+            ticker, executed = split.get("ticker"), split.get("execution_date")
+            split_from, split_to = split.get("split_from"), split.get("split_to")
+            if not ticker or not executed or not split_from or not split_to:
+                continue
+            ratio = float(split_from) / float(split_to)
+            for day, closes in self.closes.items():
+                if day < executed and ticker in closes:
+                    closes[ticker] *= ratio
+                    touched.add(ticker)
+        return len(touched)
+
+    # Brings the stored closes in line with splits since the last fill, fetches every missing trading day
+    # and drops days older than the history window
+    @timed("bar_store_fill")
+    async def fill(self, scheduler, until: date = None):
+        today = datetime.now().date().isoformat()
+        # Adjusted closes are adjusted as of the request, so older rows need rescaling after a split
+        if self.closes and self.splits_checked < today:
+            splits = await self._fetch_splits(scheduler, self.splits_checked, today)
+            if splits is None:
+                print("Could not check for splits, keeping the stored bars until the next fill")
+                return
+            touched = self.apply_splits(splits)
+            if touched:
+                print(f"Rescaled stored closes for {touched} tickers after splits")
+        self.splits_checked = today
+
+        # Today's bar is only published after the close, so default to yesterday
+        until = until or (datetime.now().date() - timedelta(days=1))
+        missing = self._missing_days(until)
+        if missing:
+            print(f"Fetching grouped daily bars for {len(missing)} days")
+        fetched = await asyncio.gather(*(self._fetch_day(scheduler, day) for day in missing))
+        for day, closes in fetched:
+            if not closes:
+                # Transient error or a trading day that is not published yet, retried on the next fill
+                continue
+            self.closes[day] = closes
+        for day in self.trading_days()[:-self.history_days]:
+            del self.closes[day]
+
+    def close_matrix(self, tickers: list) -> tuple:
+        """Returns (days, closes) where closes is a tickers x days array, NaN where no bar exists"""
+        days = self.trading_days()
+        matrix = np.full((len(tickers), len(days)), np.nan)
+        for j, day in enumerate(days):
+            column = self.closes[day]
+            for i, ticker in enumerate(tickers):
+                close = column.get(ticker)
+                if close is not None:
+                    matrix[i, j] = close
+        return days, matrix
+
+
+def fill_gaps(closes: np.ndarray) -> np.ndarray:
+    """Forward fills missing closes along the day axis, then back fills leading gaps,
+    so a missing bar counts as an unchanged price
+    """
+    valid = ~np.isnan(closes)
+    index = np.where(valid, np.arange(closes.shape[1]), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    filled = np.take_along_axis(closes, index, axis=1)
+    first = np.argmax(valid, axis=1)
+    leading = np.arange(closes.shape[1]) < first[:, None]
+    first_close = np.take_along_axis(closes, first[:, None], axis=1)
+    return np.where(leading, first_close, filled)
+
+
+# Wilder-smoothed RSI for every row of a tickers x days close matrix, returns the full series
+def compute_rsi(closes: np.ndarray, window: int = 14) -> np.ndarray:
+    closes = np.asarray(closes, dtype=float)
+    rsi = np.full(closes.shape, np.nan)
+    if closes.shape[1] <= window:
+        return rsi
+    enough = np.count_nonzero(~np.isnan(closes), axis=1) > window
+    filled = fill_gaps(closes)
+    deltas = np.diff(filled, axis=1)
+    gains = np.clip(deltas, 0, None)
+    losses = np.clip(-deltas, 0, None)
+
+    avg_gain = gains[:, :window].mean(axis=1)
+    avg_loss = losses[:, :window].mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for t in range(window, deltas.shape[1] + 1):
+            if t > window:
+                avg_gain = (avg_gain * (window - 1) + gains[:, t - 1]) / window
+                avg_loss = (avg_loss * (window - 1) + losses[:, t - 1]) / window
+            rs = avg_gain / avg_loss
+            rsi[:, t] = np.where(avg_loss == 0, 100.0, 100.0 - 100.0 / (1.0 + rs))
+    rsi[~enough] = np.nan
+    return rsi
@@ -0,0 +1,335 @@
+"""Offline benchmark for the full scan pipeline.
+
+Starts local stand-ins for Polygon, the NASDAQ screener and the Discord webhook, then runs the real
+main.run against them for each universe size and prints one JSON report per run.
+
+    python benchmark.py --sizes 1000,10000,50000 --latency-ms 20 --error-rate 0.01 --rate-limit-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import zlib
+import math
+from datetime import date
+from aiohttp import web
+
+
+# Every setting the pipeline reads, pinned so the shell environment cannot change what is measured
+BENCHMARK_SETTINGS = {
+    "POLYGON_API_KEY": "benchmark",
+    "USE_TIMER": "False",
+    "LOOP": "False",
+    "SHOW_LOW_RSI": "True",
+    "SHOW_HIGH_RSI": "True",
+    "RSI_OVERBOUGHT": "70",
+    "RSI_OVERSOLD": "30",
+    "MAX_TICKERS": "0",
+    "SCREEN_RULES": "",
+    "ALERT_DEDUP": "True",
+    "ALERT_ESCALATION_STEP": "5",
+    "ALERT_FLUSH_SECONDS": "2",
+    "ALERT_STATE_PATH": "data/alerts.db",
+    "BAR_HISTORY_DAYS": "60",
+    "BAR_STORE_PATH": "data/daily_bars.npz",
+    "UNIVERSE_CACHE_DIR": "data",
+    "UNIVERSE_TTL_HOURS": "0",
+    "FETCH_MAX_RETRIES": "3",
+    "DISCORD_COALESCE_SECONDS": "1",
+    "DISCORD_MAX_ATTEMPTS": "10",
+    "HEATMAP_SOURCES": "",
+    "HEATMAP_HASH_THRESHOLD": "4",
+    "SHARD_WORKERS": "0",
+    "SHARD_SIZE": "250",
+    "SHARD_MAX_ATTEMPTS": "3",
+    "SHARD_QUEUE_DIR": "",
+    "SHARD_LEASE_SECONDS": "300",
+    "SHARD_TIMEOUT_SECONDS": "1800",
+    "SCHEDULE": "open+16",
+    "PREWARM_SECONDS": "120",
+    "CATCH_UP_MINUTES": "30",
+    "METRICS_PORT": "",
+    "METRICS_REPORT_DIR": "",
+}
+
+
+def _synthetic_ticker(index: int) -> str:
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+# Local stand-ins for api.polygon.io, api.nasdaq.com and the Discord webhook
+class StandIns:
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, rate_limit_rate: float):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.universe_size = 1000
+        self.reset()
+
+    def reset(self):
+        self.first_alert_at = None
+        self.webhooks = 0
+        self.requests = 0
+
+    async def _delay(self):
+        delay = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _injected_failure(self):
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return web.json_response({"retry_after": 0.05}, status=429, headers={"Retry-After": "0.05"})
+        if roll < self.rate_limit_rate + self.error_rate:
+            return web.Response(status=503)
+        return None
+
+    async def rsi(self, request):
+        self.requests += 1
+        await self._delay()
+        failure = self._injected_failure()
+        if failure is not None:
+            return failure
+        ticker = request.match_info["ticker"]
+        # Stable per ticker, about 5% of the universe past the 30/70 thresholds
+        share = zlib.crc32(ticker.encode()) % 10000 / 10000
+        if share < 0.025:
+            value = share * 1000
+        elif share > 0.975:
+            value = 75 + (share - 0.975) * 1000
+        else:
+            value = 30 + (share - 0.025) / 0.95 * 40
+        return web.json_response({
+            "status": "OK",
+            "results": {"values": [{"timestamp": int(time.time() * 1000), "value": value}]},
+        })
+
+    async def grouped_daily(self, request):
+        self.requests += 1
+        await self._delay()
+        failure = self._injected_failure()
+        if failure is not None:
+            return failure
+        ordinal = date.fromisoformat(request.match_info["day"]).toordinal()
+        results = []
+        for i in range(self.universe_size):
+            # Each ticker swings on its own slow cycle, so some end up oversold or overbought
+            seed = zlib.crc32(str(i).encode())
+            cycle = 0.05 + seed % 100 / 1000
+            close = (20 + seed % 500) * (1 + 0.15 * math.sin(ordinal * cycle + seed % 628 / 100))
+            results.append({"T": _synthetic_ticker(i), "c": round(close, 2)})
+        return web.json_response({"status": "OK", "resultsCount": len(results), "results": results})
+
+    async def splits(self, request):
+        return web.json_response({"status": "OK", "results": []})
+
+    async def market_status(self, request):
+        return web.json_response({"market": "open"})
+
+    async def screener(self, request):
+        self.requests += 1
+        await self._delay()
+        rows = [
+            {"symbol": _synthetic_ticker(i), "marketCap": str(self.universe_size - i)}
+            for i in range(self.universe_size)
+        ]
+        return web.json_response({"data": {"rows": rows}})
+
+    async def webhook(self, request):
+        await request.read()
+        await self._delay()
+        if random.random() < self.rate_limit_rate:
+            return web.json_response({"retry_after": 0.05}, status=429, headers={"Retry-After": "0.05"})
+        if self.first_alert_at is None:
+            self.first_alert_at = time.time()
+        self.webhooks += 1
+        return web.Response(status=204, headers={"X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "0.1"})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/v1/indicators/rsi/{ticker}", self.rsi)
+        app.router.add_get("/v2/aggs/grouped/locale/us/market/stocks/{day}", self.grouped_daily)
+        app.router.add_get("/v3/reference/splits", self.splits)
+        app.router.add_get("/v1/marketstatus/now", self.market_status)
+        app.router.add_get("/api/screener/stocks", self.screener)
+        app.router.add_post("/webhook", self.webhook)
+        return app
+
+
+def _percentile(values: list, percentile: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+# Child process: runs main.run against the stand-ins and prints its measurements as JSON.
+# With `trace_memory` the run is only used for the peak Python heap, tracemalloc slows everything else down
+async def _child(trace_memory: bool = False):
+    import tracemalloc
+    import resource
+    import aiohttp
+    import dotenv
+
+    # Settings come only from the pinned environment, never from a .env file next to the repo
+    dotenv.load_dotenv = lambda *args, **kwargs: False
+    import fetcher
+    import metrics
+
+    latencies = {}
+
+    async def on_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_end(session, context, params):
+        latencies.setdefault(params.url.path.split("/")[1], []).append((time.perf_counter() - context.started) * 1000)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_start)
+    trace.on_request_end.append(on_end)
+    fetcher.TRACE_CONFIGS.append(trace)
+
+    import main
+    from discord import close_delivery_queue
+    from chrome_driver import close_capture_service
+
+    if trace_memory:
+        tracemalloc.start()
+    started_wall = time.time()
+    started = time.perf_counter()
+    await main.run()
+    stages = {name: stage["total_seconds"] for name, stage in metrics.REGISTRY.report()["stages"].items()}
+    # main.run also waits for webhook delivery, which is reported as its own stage
+    scan_seconds = stages.get("universe_fetch", 0) + stages.get("scan", 0)
+    stats = fetcher.get_scheduler().stats
+    requests = {"succeeded": stats.succeeded, "retried": stats.retried, "failed": stats.failed}
+    await close_delivery_queue()
+    total_seconds = time.perf_counter() - started
+    await fetcher.close_scheduler()
+    await close_capture_service()
+    peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+
+    polygon = latencies.get("v1", []) + latencies.get("v2", [])
+    print(json.dumps({
+        "started_at": started_wall,
+        "tickers": len(main.STOCK_TICKERS),
+        "scan_seconds": round(scan_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "polygon_requests": len(polygon),
+        "throughput_rps": round(len(polygon) / scan_seconds, 1) if scan_seconds else None,
+        "tickers_per_second": round(len(main.STOCK_TICKERS) / scan_seconds, 1) if scan_seconds else None,
+        "latency_ms": {
+            "p50": _percentile(polygon, 50),
+            "p99": _percentile(polygon, 99),
+        },
+        "requests": requests,
+        "stages": stages,
+        "peak_memory_mb": {
+            "python_heap": round(peak / 2 ** 20, 1) if peak is not None else None,
+            "max_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+    }))
+
+
+async def _run_child(env: dict, trace_memory: bool) -> tuple:
+    """Runs one child in a fresh working directory, returns (report, error)"""
+    with tempfile.TemporaryDirectory() as workdir:
+        command = [sys.executable, os.path.abspath(__file__), "--child"] + (["--trace-memory"] if trace_memory else [])
+        process = await asyncio.create_subprocess_exec(
+            *command, cwd=workdir, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        return None, stderr.decode()[-2000:]
+    return json.loads(stdout.decode().strip().splitlines()[-1]), None
+
+
+async def _run_size(stand_ins: StandIns, size: int, base_urls: tuple, args) -> dict:
+    polygon, nasdaq, discord = base_urls
+    stand_ins.universe_size = size
+    env = dict(os.environ)
+    env.update(BENCHMARK_SETTINGS)
+    env.update({
+        "POLYGON_BASE_URL": polygon,
+        "NASDAQ_BASE_URL": nasdaq,
+        "DISCORD_WEBHOOK_URL": f"{discord}/webhook",
+        "POLYGON_RATE_LIMIT": str(args.polygon_rate),
+        "FETCH_CONCURRENCY": str(args.concurrency),
+        "USE_BAR_STORE": "True" if args.bar_store else "False",
+    })
+    peak_heap = None
+    if args.trace_memory:
+        # Separate pass, so the timed run below is not slowed down by tracemalloc
+        stand_ins.reset()
+        traced, error = await _run_child(env, trace_memory=True)
+        if error:
+            return {"size": size, "error": error}
+        peak_heap = traced["peak_memory_mb"]["python_heap"]
+
+    stand_ins.reset()
+    report, error = await _run_child(env, trace_memory=False)
+    if error:
+        return {"size": size, "error": error}
+    report["peak_memory_mb"]["python_heap"] = peak_heap
+    started_at = report.pop("started_at")
+    report = {"size": size, "mode": "bar_store" if args.bar_store else "per_ticker", **report}
+    report["time_to_first_alert_seconds"] = (
+        round(stand_ins.first_alert_at - started_at, 3) if stand_ins.first_alert_at else None
+    )
+    report["webhooks_delivered"] = stand_ins.webhooks
+    return report
+
+
+async def _main(args):
+    stand_ins = StandIns(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    runner = web.AppRunner(stand_ins.app(), access_log=None)
+    await runner.setup()
+    # One port per service, so each gets its own rate limit bucket like the real hosts
+    for _ in range(3):
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+    polygon, nasdaq, discord = (f"http://127.0.0.1:{port}" for _, port in runner.addresses[:3])
+
+    reports = []
+    try:
+        for size in args.sizes:
+            report = await _run_size(stand_ins, size, (polygon, nasdaq, discord), args)
+            print(json.dumps(report), flush=True)
+            reports.append(report)
+    finally:
+        await runner.cleanup()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"generated_at": time.time(), "config": vars(args), "runs": reports}, file, indent=2)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the scan pipeline")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 10000, 50000])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Polygon requests answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--polygon-rate", type=float, default=1000, help="POLYGON_RATE_LIMIT for the scan")
+    parser.add_argument("--concurrency", type=int, default=50, help="FETCH_CONCURRENCY for the scan")
+    parser.add_argument("--bar-store", action="store_true", help="scan with USE_BAR_STORE=True")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the peak Python heap with tracemalloc in an extra, untimed run")
+    parser.add_argument("--output", help="also write all runs to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        asyncio.run(_child("--trace-memory" in sys.argv))
+    else:
+        asyncio.run(_main(_parse_args()))
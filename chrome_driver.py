@@ -1,33 +1,225 @@
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException, TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops
 from time import sleep
+import asyncio
+import io
+import json
 import os
+import dotenv
+from metrics import timed
+
+
+dotenv.load_dotenv()
+
+# Comma separated TradingView data sources to capture, e.g. NASDAQ100,SPX500
+HEATMAP_SOURCES: list = [s.strip() for s in os.getenv("HEATMAP_SOURCES", "NASDAQ100").split(",") if s.strip()]
+# Max differing bits between perceptual hashes for two heatmaps to count as the same image
+HEATMAP_HASH_THRESHOLD: int = int(os.getenv("HEATMAP_HASH_THRESHOLD", "4"))
+HEATMAP_HASH_PATH = "downloaded_images/posted_hashes.json"
+
+# Share of screenshot pixels that may still change between two frames for the heatmap to count as rendered,
+# leaves room for live price updates during market hours
+RENDER_TOLERANCE = 0.002
+
+# True once a large canvas shows real content, a bare <canvas> is already 300x150 before anything is drawn
+CANVAS_DRAWN_SCRIPT = """
+return Array.from(document.querySelectorAll('canvas')).some(c => {
+    const box = c.getBoundingClientRect();
+    if (box.width < 400 || box.height < 300) return false;
+    try {
+        const probe = document.createElement('canvas');
+        probe.width = probe.height = 32;
+        const context = probe.getContext('2d');
+        context.drawImage(c, 0, 0, 32, 32);
+        const pixels = context.getImageData(0, 0, 32, 32).data;
+        const colors = new Set();
+        for (let i = 0; i < pixels.length; i += 4) {
+            if (pixels[i + 3]) colors.add((pixels[i] << 16) | (pixels[i + 1] << 8) | pixels[i + 2]);
+        }
+        return colors.size >= 8;
+    } catch (e) {
+        return true;  // pixels cannot be read back, the settled screenshots decide
+    }
+});
+"""
+
+HEATMAP_URL = "https://www.tradingview.com/heatmap/stock/#%7B%22dataSource%22%3A%22{source}%22%2C%22blockColor%22%3A%22change%22%2C%22blockSize%22%3A%22market_cap_basic%22%2C%22grouping%22%3A%22sector%22%7D"
+
+
+def heatmap_url(source: str = "NASDAQ100") -> str:
+    return HEATMAP_URL.format(source=source)
+
+
+def perceptual_hash(png: bytes) -> int:
+    """64 bit difference hash, close images differ in only a few bits"""
+    image = Image.open(io.BytesIO(png)).convert("L").resize((9, 8))
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def hash_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def changed_fraction(a: bytes, b: bytes) -> float:
+    """Share of pixels that differ between two full resolution screenshots"""
+    first = Image.open(io.BytesIO(a)).convert("RGB")
+    second = Image.open(io.BytesIO(b)).convert("RGB")
+    if first.size != second.size:
+        return 1.0
+    histogram = ImageChops.difference(first, second).convert("L").histogram()
+    return 1 - histogram[0] / (first.size[0] * first.size[1])
+
+
+# Keeps one headless Chrome warm in a dedicated thread, so captures never block the event loop
+class HeatmapCapture:
+    def __init__(self, render_timeout: float = 30):
+        self.render_timeout = render_timeout
+        # Selenium drivers are not thread safe, every browser call goes through this one thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="heatmap")
+        self.driver = None
+
+    def _start(self):
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless=new")
+        options.add_argument("--window-size=1920,1080")
+        options.add_argument("--hide-scrollbars")
+        self.driver = webdriver.Chrome(options=options)
+
+    def _wait_for_render(self) -> bytes:
+        """Waits for the page load, a heatmap canvas with drawn content and two full screenshots in a row
+        that (nearly) match, returns the settled screenshot
+        """
+        wait = WebDriverWait(self.driver, self.render_timeout)
+        wait.until(lambda d: d.execute_script("return document.readyState") == "complete")
+        wait.until(lambda d: d.execute_script(CANVAS_DRAWN_SCRIPT))
+        previous = None
+        for _ in range(int(self.render_timeout * 2)):
+            png = self.driver.get_screenshot_as_png()
+            if previous is not None and changed_fraction(previous, png) <= RENDER_TOLERANCE:
+                return png
+            previous = png
+            sleep(0.5)
+        raise TimeoutException("Heatmap did not stop changing")
+
+    def capture_sync(self, url: str, path: str) -> str:
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        for attempt in range(2):
+            try:
+                if self.driver is None:
+                    self._start()
+                self.driver.get(url)
+                png = self._wait_for_render()
+                break
+            except WebDriverException:
+                # The browser died or hung, start a fresh one once
+                self.quit_sync()
+                if attempt:
+                    raise
+        with open(path, "wb") as file:
+            file.write(png)
+        return path
+
+    def quit_sync(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                pass
+            self.driver = None
+
+    @timed("heatmap_capture")
+    async def capture(self, url: str, path: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.capture_sync, url, path)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.quit_sync)
+        self.executor.shutdown(wait=False)
+
+
+_capture: HeatmapCapture = None
+
+
+def get_capture_service() -> HeatmapCapture:
+    global _capture
+    if _capture is None:
+        _capture = HeatmapCapture()
+    return _capture
+
+
+async def close_capture_service():
+    global _capture
+    if _capture is not None:
+        await _capture.close()
+        _capture = None
+
+
+def _load_posted_hashes() -> dict:
+    try:
+        with open(HEATMAP_HASH_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_posted_hashes(hashes: dict):
+    directory = os.path.dirname(HEATMAP_HASH_PATH)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(HEATMAP_HASH_PATH, "w") as file:
+        json.dump(hashes, file)
+
+
+# Records a heatmap as posted, called once the upload has been delivered
+def mark_posted(source: str, image_hash: int):
+    hashes = _load_posted_hashes()
+    hashes[source] = image_hash
+    _save_posted_hashes(hashes)
+
+
+# Captures each data source's heatmap, returns (source, path, hash) for the ones that changed since last posted
+async def capture_changed_heatmaps(sources: list = None) -> list:
+    service = get_capture_service()
+    hashes = _load_posted_hashes()
+    changed = []
+    for source in sources or HEATMAP_SOURCES:
+        path = f"downloaded_images/tradingview_heatmap_{source.lower()}.png"
+        try:
+            await service.capture(heatmap_url(source), path)
+        except WebDriverException as e:
+            print(f"Failed to capture {source} heatmap: {type(e).__name__}")
+            continue
+        with open(path, "rb") as file:
+            current = perceptual_hash(file.read())
+        previous = hashes.get(source)
+        if previous is not None and hash_distance(current, previous) <= HEATMAP_HASH_THRESHOLD:
+            print(f"{source} heatmap unchanged, skipping upload")
+            continue
+        changed.append((source, path, current))
+    return changed
+
 
 # Creates an image of the heatmap, returns the relative path of the file
+@timed("request_heatmap_nasdaq")
 def request_heatmap_nasdaq() -> str:
     relative_path = "downloaded_images/tradingview_heatmap.png"
-    url = "https://www.tradingview.com/heatmap/stock/#%7B%22dataSource%22%3A%22NASDAQ100%22%2C%22blockColor%22%3A%22change%22%2C%22blockSize%22%3A%22market_cap_basic%22%2C%22grouping%22%3A%22sector%22%7D"
-    return request_website(url, relative_path)
+    return request_website(heatmap_url("NASDAQ100"), relative_path)
+
 
+def request_website(url: str, path: str) -> str:
     """Requests website and takes picture and saved in the given path
     Returns the given path
     """
-def request_website(url: str, path: str) -> str:
-    
-    if not os.path.exists("downloaded_images"):
-        os.makedirs("downloaded_images/")
-    
-    # 1. create a web driver instance
-    driver = webdriver.Chrome()
-
-    # 2. navigate to the website
-    driver.get(url)
-    
-    sleep(1)
-
-    # 3. save a screenshot of the current page
-    driver.save_screenshot(path)
-
-    # 4. close the web driver
-    driver.quit()
-    
-    return path
\ No newline at end of file
+    service = get_capture_service()
+    return service.executor.submit(service.capture_sync, url, path).result()
@@ -1,45 +1,30 @@
 
 import asyncio
 import aiohttp
-import json
 from datetime import datetime
 import os
 import dotenv
+from fetcher import get_scheduler
+from metrics import timed
+from screener import ScreenResult
 
 
 dotenv.load_dotenv()
 
 DISCORD_WEBHOOK_URL: str = os.getenv("DISCORD_WEBHOOK_URL")
+# Seconds the delivery queue waits to merge alert batches that arrive close together
+DISCORD_COALESCE_SECONDS: float = float(os.getenv("DISCORD_COALESCE_SECONDS", "1"))
+DISCORD_MAX_ATTEMPTS: int = int(os.getenv("DISCORD_MAX_ATTEMPTS", "10"))
 
-async def send_image(local_path):
-    async with aiohttp.ClientSession() as session:
-        with open(local_path, "rb") as file:
-            form_data = aiohttp.FormData()
-            form_data.add_field("username", "RSI Bot")
-            form_data.add_field("avatar_url", "https://i.imgur.com/4M34hi2.png")
-            form_data.add_field('file', file, filename='image.png', content_type='image/png')
-            async with session.post(DISCORD_WEBHOOK_URL, data=form_data) as response:
-                if response.status == 204:
-                    print("Webhook sent successfully with all perspectives")
-                else:
-                    print(f"Failed to send webhook: {response.status}")
-                    
-
-# Async function to send a compact Discord webhook with all perspectives
-async def send_discord_webhook(perspectives):
-    if not perspectives:
-        print("No perspectives to send.")
-        return
-    
-    # Compact content for oversold tickers (under 2000 chars)
-    oversold = [t for t, _, s, _ in perspectives if s == "Oversold"]
-    content = f"**Oversold:** {', '.join(oversold) if oversold else 'None'}\n"
+# Discord webhook limits
+MAX_CONTENT_CHARS = 1900  # Buffer for Discord's 2000 char limit
+MAX_FIELDS_PER_EMBED = 25
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
 
-    if len(content) > 1900:  # Buffer for Discord's 2000 char limit
-        content = content[:1897] + "..."
 
-    # Single embed for all perspectives (max 10 entries)
-    embed = {
+def _new_embed() -> dict:
+    return {
         "title": "RSI Alerts",
         "description": "Latest RSI statuses:",
         "color": 0x55FF55,  # Default green, adjusted below if needed
@@ -48,39 +33,239 @@ async def send_discord_webhook(perspectives):
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    # Add up to 10 perspectives to a single embed
-    for i, (ticker, rsi, status, timestamp) in enumerate(perspectives):
-        if i == 0 and status == "Overbought":
-            embed["color"] = 0xFF5555  # Red if first is overbought
-        date = datetime.fromtimestamp(timestamp / 1000).strftime("%m-%d %H:%M")
-        field = {
-            "name": f"{ticker} {'📈' if status == 'Overbought' else '📉'}",
-            "value": f"RSI: `{rsi:.1f}` | {status}",
-            "inline": True
-        }
-        embed["fields"].append(field)
 
-    # if len(perspectives) > 10:
-    #     embed["footer"]["text"] += f" | {len(perspectives) - 10} more not shown"
+def _embed_header_chars(embed: dict) -> int:
+    return len(embed["title"]) + len(embed["description"]) + len(embed["footer"]["text"])
+
 
-    # Minimal payload
-    payload = {
-        "username": "RSI Bot",
-        "content": content,
-        "embeds": [embed] if embed["fields"] else []
+def _field(perspective: tuple) -> dict:
+    # Perspectives may carry (indicator, event) after the timestamp
+    ticker, rsi, status, timestamp, *extra = perspective
+    indicator = extra[0] if extra else "RSI"
+    event = f" | {extra[1]}" if len(extra) > 1 and extra[1] else ""
+    return {
+        "name": f"{ticker} {'📈' if status == 'Overbought' else '📉'}",
+        "value": f"{indicator}: `{rsi:.1f}` | {status}{event}",
+        "inline": True
     }
 
-    # Check size and trim if necessary
-    payload_str = json.dumps(payload)
-    if len(payload_str) > 6000:
-        print("Payload too large, trimming...")
-        embed["fields"] = embed["fields"][:5]  # Limit to 5 entries
-        payload["embeds"] = [embed]
-        payload_str = json.dumps(payload)
-        if len(payload_str) > 6000:
-            payload = {"username": "RSI Bot", "content": content[:1900]}
-
-    # Send the webhook
-    async with aiohttp.ClientSession() as session:
-        async with session.post(DISCORD_WEBHOOK_URL, json=payload) as response:
-            print("Webhook sent successfully" if response.status == 204 else f"Failed: {response.status}")
\ No newline at end of file
+
+def _content_chunks(tickers: list) -> list:
+    """Splits the oversold summary line into pieces that each fit in one message"""
+    if not tickers:
+        return ["**Oversold:** None\n"]
+    chunks, line = [], "**Oversold:** "
+    for ticker in tickers:
+        part = ticker if line.endswith(" ") else f", {ticker}"
+        if len(line) + len(part) > MAX_CONTENT_CHARS:
+            chunks.append(line + "\n")
+            line, part = "**Oversold (cont.):** ", ticker
+        line += part
+    chunks.append(line + "\n")
+    return chunks
+
+
+def _seconds(value: str, default: float = 1.0) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+# Splits perspectives into as many webhook payloads as needed to stay inside Discord's limits
+def build_payloads(perspectives: list) -> list:
+    # Exits are no longer oversold
+    oversold = [t for t, _, s, _, *extra in perspectives if s == "Oversold" and extra[1:] != ["Exit"]]
+    contents = _content_chunks(oversold)
+
+    messages, embeds, chars = [], [], 0
+    for perspective in perspectives:
+        field = _field(perspective)
+        size = len(field["name"]) + len(field["value"])
+        embed = embeds[-1] if embeds else None
+        if embed is None or len(embed["fields"]) >= MAX_FIELDS_PER_EMBED or chars + size > MAX_EMBED_CHARS_PER_MESSAGE:
+            embed = _new_embed()
+            header = _embed_header_chars(embed)
+            if len(embeds) >= MAX_EMBEDS_PER_MESSAGE or chars + header + size > MAX_EMBED_CHARS_PER_MESSAGE:
+                messages.append(embeds)
+                embeds, chars = [], 0
+            if perspective[2] == "Overbought":
+                embed["color"] = 0xFF5555  # Red if first is overbought
+            embeds.append(embed)
+            chars += header
+        embed["fields"].append(field)
+        chars += size
+    if embeds:
+        messages.append(embeds)
+
+    return [
+        {
+            "username": "RSI Bot",
+            "content": contents[i] if i < len(contents) else "",
+            "embeds": messages[i] if i < len(messages) else []
+        }
+        for i in range(max(len(contents), len(messages)))
+    ]
+
+
+# Background webhook sender: one worker for the life of the process, so callers never wait on Discord
+class DeliveryQueue:
+    def __init__(self, webhook_url: str = DISCORD_WEBHOOK_URL, coalesce_seconds: float = DISCORD_COALESCE_SECONDS,
+                 max_attempts: int = DISCORD_MAX_ATTEMPTS):
+        self.webhook_url = webhook_url
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue()
+        self.worker: asyncio.Task = None
+        self.retries = set()  # sleeping re-queue tasks, so a failing message never blocks the worker
+
+    def _put(self, job: tuple):
+        self.queue.put_nowait(job)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    def put_alerts(self, perspectives: list, on_delivered=None):
+        """`on_delivered` is called once Discord has accepted every message the alerts were sent in"""
+        self._put(("alerts", (list(perspectives), [on_delivered] if on_delivered else []), 0))
+
+    def put_image(self, image: bytes, on_delivered=None):
+        """`on_delivered` is called once Discord has accepted the upload"""
+        self._put(("image", ([image], [on_delivered] if on_delivered else [], True), 0))
+
+    def _coalesce(self, perspectives: list, callbacks: list) -> tuple:
+        """Merges every alert batch already waiting in the queue into `perspectives` and `callbacks`"""
+        others = []
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            if job[0] == "alerts":
+                perspectives.extend(job[1][0])
+                callbacks.extend(job[1][1])
+            else:
+                others.append(job)
+            self.queue.task_done()
+        for job in others:
+            self.queue.put_nowait(job)
+        return perspectives, callbacks
+
+    async def _post(self, kind: str, body) -> int:
+        if kind == "image":
+            # Form data can only be sent once, so build a fresh one for every attempt
+            def form_data():
+                form = aiohttp.FormData()
+                form.add_field("username", "RSI Bot")
+                form.add_field("avatar_url", "https://i.imgur.com/4M34hi2.png")
+                form.add_field('file', body, filename='image.png', content_type='image/png')
+                return form
+            kwargs = {"data": form_data}
+        else:
+            kwargs = {"json": body}
+        # Retries are owned by the queue, a retry inside the scheduler too would multiply duplicate posts
+        status, _, headers = await get_scheduler().post(
+            self.webhook_url, parse=None, with_headers=True, max_retries=0, **kwargs
+        )
+
+        # Wait out the bucket before the next message instead of running into a 429
+        if headers.get("X-RateLimit-Remaining") == "0":
+            await asyncio.sleep(_seconds(headers.get("X-RateLimit-Reset-After")))
+        elif status == 429:
+            await asyncio.sleep(_seconds(headers.get("Retry-After")))
+        return status
+
+    def _retry_later(self, delay: float, job: tuple):
+        async def requeue():
+            await asyncio.sleep(delay)
+            self._put(job)
+        task = asyncio.create_task(requeue())
+        self.retries.add(task)
+        task.add_done_callback(self.retries.discard)
+
+    @timed("webhook_delivery")
+    async def _deliver(self, kind: str, body, attempts: int):
+        """Sends `body` = (messages, callbacks, complete) in order, an image upload or a batch of alert payloads.
+        The callbacks run once the last message is through, if none was given up on.
+        `attempts` counts the tries of the first message
+        """
+        messages, callbacks, complete = body
+        for index, message in enumerate(messages):
+            status = await self._post("image" if kind == "image" else "payload", message)
+            if status in (200, 204):
+                print("Webhook sent successfully" if kind == "payloads" else "Webhook sent successfully with image")
+            elif (status is None or status == 429 or status >= 500) and attempts + 1 < self.max_attempts:
+                delay = min(60, 2 ** attempts)
+                print(f"Failed to send webhook: {status}, retrying in {delay}s")
+                # The rest of the batch waits with it, so split alert messages keep their order
+                self._retry_later(delay, (kind, (messages[index:], callbacks, complete), attempts + 1))
+                return
+            else:
+                print(f"Failed to send webhook: {status}, giving up after {attempts + 1} attempts")
+                complete = False
+            attempts = 0
+        if complete:
+            for callback in callbacks:
+                callback()
+
+    async def _run(self):
+        while True:
+            kind, body, attempts = await self.queue.get()
+            try:
+                if kind == "alerts":
+                    await asyncio.sleep(self.coalesce_seconds)
+                    perspectives, callbacks = self._coalesce(*body)
+                    await self._deliver("payloads", (build_payloads(perspectives), callbacks, True), 0)
+                else:
+                    await self._deliver(kind, body, attempts)
+            except Exception as e:
+                print(f"Exception while sending webhook: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        """Waits until every queued message has been delivered or given up on"""
+        await self.queue.join()
+        while self.retries:
+            await asyncio.gather(*self.retries, return_exceptions=True)
+            await self.queue.join()
+
+    async def close(self):
+        await self.drain()
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+            self.worker = None
+
+
+_delivery: DeliveryQueue = None
+
+
+def get_delivery_queue() -> DeliveryQueue:
+    global _delivery
+    if _delivery is None:
+        _delivery = DeliveryQueue()
+    return _delivery
+
+
+async def close_delivery_queue():
+    global _delivery
+    if _delivery is not None:
+        await _delivery.close()
+        _delivery = None
+
+
+# Queues an image for the webhook, returns without waiting for the upload
+async def send_image(local_path, on_delivered=None):
+    with open(local_path, "rb") as file:
+        get_delivery_queue().put_image(file.read(), on_delivered)
+
+
+# Queues all perspectives for the webhook, split over as many messages as Discord's limits need,
+# `on_delivered` is called once all of them are accepted
+async def send_discord_webhook(perspectives, on_delivered=None):
+    # Screening results render one field per matched ticker and rule
+    if isinstance(perspectives, ScreenResult):
+        perspectives = perspectives.to_perspectives()
+
+    if not perspectives:
+        print("No perspectives to send.")
+        return
+
+    get_delivery_queue().put_alerts(perspectives, on_delivered)
@@ -0,0 +1,207 @@
+import os
+import time
+import random
+import asyncio
+import aiohttp
+import dotenv
+from urllib.parse import urlsplit
+from metrics import REGISTRY, endpoint_label
+from sleeping import PREWARM_SECONDS
+
+
+dotenv.load_dotenv()
+
+# Max requests in flight across all hosts
+FETCH_CONCURRENCY: int = int(os.getenv("FETCH_CONCURRENCY", "50"))
+# Polygon requests per second, match this to the plan (the free plan allows 5 per minute)
+POLYGON_RATE_LIMIT: float = float(os.getenv("POLYGON_RATE_LIMIT", "50"))
+FETCH_MAX_RETRIES: int = int(os.getenv("FETCH_MAX_RETRIES", "3"))
+
+# Service locations, overridable to point the bot at local stand-ins (see benchmark.py)
+POLYGON_BASE_URL: str = os.getenv("POLYGON_BASE_URL", "https://api.polygon.io")
+NASDAQ_BASE_URL: str = os.getenv("NASDAQ_BASE_URL", "https://api.nasdaq.com")
+DISCORD_WEBHOOK_URL: str = os.getenv("DISCORD_WEBHOOK_URL") or "https://discord.com"
+
+# Requests per second and burst size for each host, hosts not listed are only capped by concurrency
+HOST_RATE_LIMITS = {
+    urlsplit(POLYGON_BASE_URL).netloc: (POLYGON_RATE_LIMIT, max(1, int(POLYGON_RATE_LIMIT))),
+    urlsplit(NASDAQ_BASE_URL).netloc: (2, 2),
+    urlsplit(DISCORD_WEBHOOK_URL).netloc: (1, 5),
+}
+
+# aiohttp.TraceConfig hooks attached to every session, e.g. to time requests
+TRACE_CONFIGS: list = []
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+
+    def summary(self) -> str:
+        return f"Requests: {self.succeeded} succeeded, {self.retried} retried, {self.failed} failed"
+
+
+def _retry_delay(attempt: int, retry_after: str = None) -> float:
+    """Seconds to wait before the next attempt, `Retry-After` wins over the jittered exponential backoff"""
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+# Shared HTTP client: one tuned connection pool, bounded concurrency, per-host rate limits and retries
+class RequestScheduler:
+    def __init__(self, concurrency: int = FETCH_CONCURRENCY, host_limits: dict = None,
+                 max_retries: int = FETCH_MAX_RETRIES):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.buckets = {
+            host: TokenBucket(rate, burst)
+            for host, (rate, burst) in (HOST_RATE_LIMITS if host_limits is None else host_limits).items()
+        }
+        self.stats = FetchStats()
+        self.session: aiohttp.ClientSession = None
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.concurrency,
+                ttl_dns_cache=300,
+                # Outlives the gap between the pre-warm and the run, so the scan starts on warm connections
+                keepalive_timeout=PREWARM_SECONDS + 60,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30, connect=10),
+                trace_configs=TRACE_CONFIGS or None,
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, method: str, url: str, parse: str = "json", with_headers: bool = False,
+                      max_retries: int = None, **kwargs) -> tuple:
+        """Sends a request, retrying 429/5xx responses and connection errors.
+        `parse` is "json", "text" or None, `data` may be a callable building a fresh body per attempt.
+        `max_retries` overrides the scheduler's, 0 leaves retrying to the caller.
+        Returns (status, body), or (status, body, headers) with `with_headers`, status is None when every attempt raised
+        """
+        session = self._ensure_session()
+        bucket = self.buckets.get(urlsplit(url).netloc)
+        endpoint = {"endpoint": endpoint_label(url)}
+        data = kwargs.pop("data", None)
+        status = None
+        headers = {}
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            if bucket is not None:
+                await bucket.acquire()
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    body = data() if callable(data) else data
+                    REGISTRY.add_gauge("rsi_http_in_flight", endpoint, 1)
+                    started = time.perf_counter()
+                    try:
+                        async with session.request(method, url, data=body, **kwargs) as response:
+                            status = response.status
+                            headers = response.headers
+                            retry_after = response.headers.get("Retry-After")
+                            if status not in RETRY_STATUSES:
+                                result = None
+                                try:
+                                    if parse == "json" and status < 300 and status != 204:
+                                        result = await response.json(content_type=None)
+                                    elif parse == "text":
+                                        result = await response.text()
+                                except ValueError:
+                                    print(f"Invalid response body from {urlsplit(url).hostname}")
+                                    self._count(endpoint, "failure", "invalid_body")
+                                    return (status, None, headers) if with_headers else (status, None)
+                                if status < 400:
+                                    self._count(endpoint, "success")
+                                else:
+                                    self._count(endpoint, "failure", f"status_{status}")
+                                return (status, result, headers) if with_headers else (status, result)
+                    finally:
+                        REGISTRY.add_gauge("rsi_http_in_flight", endpoint, -1)
+                        REGISTRY.observe("rsi_http_request_duration_seconds", time.perf_counter() - started, endpoint)
+                cause = f"status_{status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = None
+                cause = type(e).__name__
+                print(f"Request to {urlsplit(url).hostname} failed: {type(e).__name__} {str(e)}")
+            if attempt < max_retries:
+                self._count(endpoint, "retry", cause)
+                await asyncio.sleep(_retry_delay(attempt, retry_after))
+        self._count(endpoint, "failure", cause)
+        return (status, None, headers) if with_headers else (status, None)
+
+    def _count(self, endpoint: dict, outcome: str, cause: str = None):
+        if outcome == "success":
+            self.stats.succeeded += 1
+        elif outcome == "retry":
+            self.stats.retried += 1
+        else:
+            self.stats.failed += 1
+        REGISTRY.inc("rsi_http_requests_total", {**endpoint, "outcome": outcome})
+        if cause:
+            REGISTRY.inc("rsi_http_errors_total", {**endpoint, "cause": cause})
+
+    async def get(self, url: str, **kwargs) -> tuple:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> tuple:
+        return await self.request("POST", url, **kwargs)
+
+
+_scheduler: RequestScheduler = None
+
+
+# Process wide scheduler, created on first use inside the running event loop
+def get_scheduler() -> RequestScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler()
+    return _scheduler
+
+
+async def close_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        await _scheduler.close()
+        _scheduler = None
@@ -1,14 +1,21 @@
 import asyncio
-import aiohttp
+import functools
 import json
+import time
 import dotenv
 import os
 from datetime import datetime
-from sleeping import run_daily_at_946am
-from tools import filter_tickers
-from nasdaq import get_nasdaq_tickers_sync
-from chrome_driver import request_heatmap_nasdaq
-from discord import send_discord_webhook, send_image
+from sleeping import MarketScheduler
+from universe import load_universe
+from chrome_driver import capture_changed_heatmaps, close_capture_service, mark_posted
+from discord import send_discord_webhook, send_image, get_delivery_queue, close_delivery_queue
+from bars import BarStore, BAR_HISTORY_DAYS
+from screener import Screener, parse_rules
+from fetcher import get_scheduler, close_scheduler, POLYGON_BASE_URL
+from alerts import AlertState, AlertBatcher
+from shard import scan_sharded, SHARD_WORKERS
+from metrics import REGISTRY, METRICS_PORT, METRICS_REPORT_DIR, stage, record_stage, timed, start_metrics_server, \
+    write_run_report
 
 
 dotenv.load_dotenv()
@@ -21,6 +28,13 @@ USE_TIMER: bool = os.getenv("USE_TIMER") != "False"
 LOOP: bool = os.getenv("LOOP") != "False"
 SHOW_LOW_RSI: str = os.getenv("SHOW_LOW_RSI") != "False"
 SHOW_HIGH_RSI: str = os.getenv("SHOW_HIGH_RSI") != "False"
+USE_BAR_STORE: bool = os.getenv("USE_BAR_STORE") == "True"
+# Largest tickers by market cap to scan, 0 scans the whole universe (meant for sharded scans)
+MAX_TICKERS: int = int(os.getenv("MAX_TICKERS", "1000"))
+# Extra screening rules for the bar store, e.g. "Dip: RSI14 < 30 and CLOSE > SMA200; Cross: SMA50 crosses_above SMA200"
+SCREEN_RULES: str = os.getenv("SCREEN_RULES", "")
+# Only alert on new threshold crossings, escalations and exits instead of every matching ticker each run
+ALERT_DEDUP: bool = os.getenv("ALERT_DEDUP") != "False"
 # DISCORD_WEBHOOK_URL = "https://discord.com/api/webhooks/1347713815273406514/Ur4ZD1C-NX9OWlYYn0Gec7Hmq-5tT9uaA4FrJPd_VlNk08ClTsakp7fhoreeUKmnO2Hs"
 
 # Define RSI limits
@@ -31,83 +45,210 @@ RSI_OVERSOLD = int(os.getenv("RSI_OVERSOLD"))    # Lower limit
 STOCK_TICKERS = []
 
 # Async function to get the latest RSI for a given ticker
-async def get_latest_rsi(session, ticker):
+@timed("get_latest_rsi")
+async def get_latest_rsi(scheduler, ticker):
     url = (
-        f"https://api.polygon.io/v1/indicators/rsi/{ticker}"
+        f"{POLYGON_BASE_URL}/v1/indicators/rsi/{ticker}"
         f"?timespan=day&adjusted=true&window=14&series_type=close"
         f"&order=desc&limit=1&apiKey={POLYGON_API_KEY}"
     )
     
     # print(f"Fetching RSI for {ticker}: {url}")
-    try:
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data["status"] == "OK" and "results" in data and "values" in data["results"]:
-                    latest_rsi = float(data["results"]["values"][0]["value"])
-                    timestamp = int(data["results"]["values"][0]["timestamp"])
-                    return ticker, latest_rsi, timestamp
-                else:
-                    print(f"Error fetching RSI for {ticker}: No valid data returned")
-                    return ticker, None, None
-            else:
-                print(f"Error fetching RSI for {ticker}: {response.status}")
-                return ticker, None, None
-    except Exception as e:
-        print(f"Exception while fetching RSI for {ticker}: {str(e)}")
+    status, data = await scheduler.get(url)
+    if status == 200 and data:
+        try:
+            if data.get("status") == "OK" and "results" in data and data["results"].get("values"):
+                latest_rsi = float(data["results"]["values"][0]["value"])
+                timestamp = int(data["results"]["values"][0]["timestamp"])
+                return ticker, latest_rsi, timestamp
+        except (KeyError, TypeError, ValueError, IndexError, AttributeError) as e:
+            # One malformed body must not abort the scan, the ticker is just unavailable this run
+            print(f"Error fetching RSI for {ticker}: Malformed response ({type(e).__name__} {str(e)})")
+            return ticker, None, None
+        print(f"Error fetching RSI for {ticker}: No valid data returned")
         return ticker, None, None
+    else:
+        print(f"Error fetching RSI for {ticker}: {status}")
+        return ticker, None, None
+
+
+# Rules for the local screener, the RSI thresholds keep their Oversold/Overbought names
+def screen_rules() -> dict:
+    rules = {}
+    if SHOW_HIGH_RSI:
+        rules["Overbought"] = f"RSI14 > {RSI_OVERBOUGHT}"
+    if SHOW_LOW_RSI:
+        rules["Oversold"] = f"RSI14 < {RSI_OVERSOLD}"
+    rules.update(parse_rules(SCREEN_RULES))
+    return rules
+
+
+# Screens all tickers locally from the grouped daily bar store, in one pass over the close matrix
+async def screen_bar_store(scheduler, tickers):
+    screener = Screener(screen_rules())
+    store = BarStore(history_days=max(BAR_HISTORY_DAYS, screener.lookback))
+    with stage("rsi_fetch"):
+        store.load()
+        await store.fill(scheduler)
+        store.save()
+    with stage("evaluation"):
+        days, closes = store.close_matrix(tickers)
+        timestamps = [int(datetime.fromisoformat(day).timestamp() * 1000) for day in days]
+        return screener.run(tickers, {"day": (timestamps, closes)})
+
+
+# Yields (ticker, rsi, timestamp) as each result arrives, from worker shards when SHARD_WORKERS is set
+async def fetch_rsi(scheduler, stock_tickers):
+    if SHARD_WORKERS > 0:
+        async for result in scan_sharded(stock_tickers):
+            yield result
+        return
+
+    # Create tasks for all tickers, the scheduler caps concurrency and request rate
+    tasks = [get_latest_rsi(scheduler, ticker) for ticker in stock_tickers]
+
+    # Evaluate each result as soon as it arrives, so one slow ticker does not hold back the rest
+    for task in asyncio.as_completed(tasks):
+        yield await task
 
 
-# Main async function to check RSI and collect perspectives
+# Records one rule evaluation and queues an alert when it is new, escalated or exited
+async def report(batcher, state, ticker, value, rule, timestamp, indicator, matched, direction):
+    if state is None:
+        if matched:
+            await batcher.add((ticker, value, rule, timestamp, indicator))
+        return
+    event = state.observe(ticker, rule, value, matched, direction)
+    if event:
+        await batcher.add((ticker, value, rule, timestamp, indicator, event))
+
+
+# Main async function to check RSI and stream alerts as results arrive
 async def check_rsi_and_alert(stock_tickers=STOCK_TICKERS):
-    perspectives = []  # List to store all notable RSI perspectives
-    
-    async with aiohttp.ClientSession() as session:
-        # Create tasks for all tickers
-        tasks = [get_latest_rsi(session, ticker) for ticker in stock_tickers]
-        results = await asyncio.gather(*tasks)
-        
-        # Process results and collect perspectives
-        for ticker, rsi, timestamp in results:
-            if rsi is None or timestamp is None:
-                continue
-            
-            if SHOW_HIGH_RSI and rsi > RSI_OVERBOUGHT:
-                perspectives.append((ticker, rsi, "Overbought", timestamp))
-            elif SHOW_LOW_RSI and rsi < RSI_OVERSOLD:
-                perspectives.append((ticker, rsi, "Oversold", timestamp))
-            else:
-                # print(f"Skipping {ticker}: RSI {rsi:.2f} is within normal range set")
-                pass
-    
-    # Send all perspectives in one webhook
-    await send_discord_webhook(perspectives)
+    scheduler = get_scheduler()
+    scheduler.stats.reset()
+    state = AlertState() if ALERT_DEDUP else None
+    # Alert state only changes once Discord has the alert, so a failed delivery is alerted again next run
+    batcher = AlertBatcher(send_discord_webhook, on_delivered=state.delivered if state is not None else None)
+    # Tickers without data this run, their alert state is kept until they can be evaluated again
+    unavailable = set()
+
+    try:
+        if USE_BAR_STORE:
+            result = await screen_bar_store(scheduler, stock_tickers)
+            with stage("evaluation"):
+                for rule, (tickers, matched, values) in result.evaluations.items():
+                    for ticker, is_match, value in zip(tickers.tolist(), matched.tolist(), values.tolist()):
+                        if value != value:  # NaN, no bars for this ticker
+                            unavailable.add(ticker)
+                            continue
+                        await report(batcher, state, ticker, value, rule, result.timestamp,
+                                     result.primary.get(rule, "Value"), is_match, result.directions.get(rule, 0))
+        else:
+            # Fetching and evaluation interleave, so the loop is split into the time spent in each
+            evaluating = 0.0
+            started = time.perf_counter()
+            async for ticker, rsi, timestamp in fetch_rsi(scheduler, stock_tickers):
+                if rsi is None or timestamp is None:
+                    unavailable.add(ticker)
+                    continue
+
+                evaluation_started = time.perf_counter()
+                if SHOW_HIGH_RSI:
+                    await report(batcher, state, ticker, rsi, "Overbought", timestamp, "RSI", rsi > RSI_OVERBOUGHT, 1)
+                if SHOW_LOW_RSI:
+                    await report(batcher, state, ticker, rsi, "Oversold", timestamp, "RSI", rsi < RSI_OVERSOLD, -1)
+                evaluating += time.perf_counter() - evaluation_started
+            record_stage("rsi_fetch", time.perf_counter() - started - evaluating)
+            record_stage("evaluation", evaluating)
+        if state is not None:
+            pruned = state.prune(unavailable)
+            if pruned:
+                print(f"Cleared {pruned} alerts for tickers or rules that are no longer scanned")
+        await batcher.close()
+    except BaseException:
+        # A scan that failed part way must not leave its pruning behind as if it had seen everything
+        if state is not None:
+            state.rollback()
+        raise
+    if state is not None:
+        state.close()
+    print(scheduler.stats.summary())
+
+
+# Captures heatmaps off the event loop and queues the ones that changed since the last post
+async def post_heatmaps():
+    # Runs alongside the scan, so this stage overlaps the others
+    with stage("heatmap_capture"):
+        changed = await capture_changed_heatmaps()
+    for source, path, image_hash in changed:
+        # Only counts as posted once Discord has the image, so a failed upload is retried next run
+        await send_image(path, functools.partial(mark_posted, source, image_hash))
+        print("Send image of current heatmap")
 
 
 async def run():
     global STOCK_TICKERS
-    STOCK_TICKERS = get_nasdaq_tickers_sync()
+    baseline = REGISTRY.snapshot()
+    # The browser works in its own thread while the scan runs
+    heatmaps = asyncio.create_task(post_heatmaps())
+    # Filtered and ranked by market cap, served from the local cache when fresh
+    with stage("universe_fetch"):
+        STOCK_TICKERS = await load_universe()
     # print(STOCK_TICKERS)
-    STOCK_TICKERS = filter_tickers(STOCK_TICKERS)[:1000]
+    if MAX_TICKERS > 0:
+        STOCK_TICKERS = STOCK_TICKERS[:MAX_TICKERS]
     if not STOCK_TICKERS:
         print("No tickers fetched, exiting.")
-        return
-    
-    print(f"Checking RSI for {len(STOCK_TICKERS)} tickers on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    await check_rsi_and_alert(STOCK_TICKERS)
+    else:
+        print(f"Checking RSI for {len(STOCK_TICKERS)} tickers on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        with stage("scan"):
+            await check_rsi_and_alert(STOCK_TICKERS)
+    try:
+        await heatmaps
+    except Exception as e:
+        print(f"Failed to post heatmaps: {str(e)}")
+    # Waits for the webhooks of this run, so delivery is part of the run and its report
+    with stage("delivery"):
+        await get_delivery_queue().drain()
+    if METRICS_REPORT_DIR:
+        print(f"Run report written to {write_run_report(baseline)}")
+
+# Gets the expensive setup out of the way shortly before a scheduled run
+async def prewarm():
+    print("Pre-warming universe, connections and indicator state")
+    tickers = await load_universe()
+    scheduler = get_scheduler()
+    # Opens a pooled keep-alive connection to Polygon ahead of the burst of requests
+    await scheduler.get(f"{POLYGON_BASE_URL}/v1/marketstatus/now?apiKey={POLYGON_API_KEY}")
+    if USE_BAR_STORE:
+        store = BarStore(history_days=max(BAR_HISTORY_DAYS, Screener(screen_rules()).lookback))
+        store.load()
+        await store.fill(scheduler)
+        store.save()
+    print(f"Pre-warmed {len(tickers)} tickers")
+
 
 # Run the script
 async def main():
-    heatmap = request_heatmap_nasdaq()
-    await send_image(heatmap)
-    print("Send image of current heatmap")
+    # Rejects bad SCREEN_RULES at startup instead of in the middle of a scan
+    Screener(screen_rules())
     ran_once = False
-    while not ran_once or LOOP:
+    metrics_server = await start_metrics_server() if METRICS_PORT else None
+    try:
         if USE_TIMER:
-            await run_daily_at_946am(run)
-        else:
+            # Runs every trading session at the SCHEDULE cadences, US/Eastern
+            await MarketScheduler(run, prewarm).run_forever()
+        while not ran_once or LOOP:
             await run()
-        ran_once = True
+            ran_once = True
+    finally:
+        # Let queued webhooks go out before the connection pool closes
+        await close_delivery_queue()
+        await close_scheduler()
+        await close_capture_service()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
 
 if __name__ == "__main__":
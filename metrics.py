@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import asyncio
+import functools
+import dotenv
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlsplit
+
+
+dotenv.load_dotenv()
+
+# Local port for the Prometheus /metrics endpoint, unset or 0 keeps it off
+METRICS_PORT: int = int(os.getenv("METRICS_PORT") or 0)
+METRICS_REPORT_DIR: str = os.getenv("METRICS_REPORT_DIR", "data/metrics")
+
+# Seconds, wide enough for a single request up to a whole morning scan
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+DESCRIPTIONS = {
+    "rsi_stage_duration_seconds": ("histogram", "Wall clock time of each stage of the run"),
+    "rsi_call_duration_seconds": ("histogram", "Latency of individual, possibly concurrent, calls by function"),
+    "rsi_http_request_duration_seconds": ("histogram", "HTTP request latency by endpoint"),
+    "rsi_http_requests_total": ("counter", "HTTP requests by endpoint and outcome (success, retry, failure)"),
+    "rsi_http_errors_total": ("counter", "Failed HTTP attempts by endpoint and cause"),
+    "rsi_http_in_flight": ("gauge", "HTTP requests currently in flight by endpoint"),
+}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{key}="{_escape(value)}"' for key, value in labels + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# In-process metric store, rendered in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, _labels(labels))
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = (name, _labels(labels))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def render(self) -> str:
+        lines = []
+        names = sorted({name for name, _ in list(self.counters) + list(self.gauges) + list(self.histograms)})
+        for name in names:
+            kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(self.counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_render_labels(labels)} {value}")
+            for (metric, labels), value in sorted(self.gauges.items()):
+                if metric == name:
+                    lines.append(f"{name}{_render_labels(labels)} {value}")
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_render_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_render_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_render_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Copy of the counters and histograms, to report on what changed since"""
+        return {
+            "counters": dict(self.counters),
+            "histograms": {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()},
+        }
+
+    def report(self, since: dict = None) -> dict:
+        """Stage wall clock times, call and per endpoint latencies and request counts since `since`"""
+        since = since or {"counters": {}, "histograms": {}}
+        report = {"stages": {}, "calls": {}, "endpoints": {}, "requests": {}, "errors": {}}
+        for key, histogram in self.histograms.items():
+            counts, total, count = histogram.counts, histogram.sum, histogram.count
+            if key in since["histograms"]:
+                old_counts, old_sum, old_count = since["histograms"][key]
+                counts = [a - b for a, b in zip(counts, old_counts)]
+                total, count = total - old_sum, count - old_count
+            if not count:
+                continue
+            name, labels = key[0], dict(key[1])
+            if name == "rsi_stage_duration_seconds":
+                # Stages never overlap themselves, so their total is time actually spent
+                report["stages"][labels["stage"]] = {"count": count, "total_seconds": round(total, 4)}
+                continue
+            # Calls overlap, a total would add up concurrent waits, so only the latency distribution is reported
+            summary = {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 2),
+                "p50_ms": _bucket_percentile(histogram.buckets, counts, 0.5),
+                "p99_ms": _bucket_percentile(histogram.buckets, counts, 0.99),
+            }
+            if name == "rsi_call_duration_seconds":
+                report["calls"][labels["call"]] = summary
+            elif name == "rsi_http_request_duration_seconds":
+                report["endpoints"][labels["endpoint"]] = summary
+        for key, value in self.counters.items():
+            value -= since["counters"].get(key, 0)
+            if not value:
+                continue
+            name, labels = key[0], dict(key[1])
+            if name == "rsi_http_requests_total":
+                report["requests"].setdefault(labels["endpoint"], {})[labels["outcome"]] = value
+            elif name == "rsi_http_errors_total":
+                report["errors"].setdefault(labels["endpoint"], {})[labels["cause"]] = value
+        return report
+
+
+def _bucket_percentile(buckets: tuple, counts: list, quantile: float) -> float:
+    """Upper bound of the bucket holding the quantile, in milliseconds"""
+    target = quantile * sum(counts)
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        if cumulative >= target:
+            return bound * 1000
+    return None
+
+
+REGISTRY = Metrics()
+
+
+def endpoint_label(url: str) -> str:
+    """host plus the first two path segments, so per ticker URLs share one label"""
+    parts = urlsplit(url)
+    segments = [segment for segment in parts.path.split("/") if segment][:2]
+    return parts.netloc + "/" + "/".join(segments)
+
+
+def record_stage(name: str, seconds: float):
+    REGISTRY.observe("rsi_stage_duration_seconds", seconds, {"stage": name})
+
+
+# Wall clock timer for one phase of a run, only for code that does not run concurrently with itself
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def _call(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("rsi_call_duration_seconds", time.perf_counter() - started, {"call": name})
+
+
+# Decorator recording the latency of every call of a sync or async function, calls may overlap
+def timed(name: str):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _call(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _call(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_run_report(since: dict, directory: str = METRICS_REPORT_DIR) -> str:
+    """Writes what happened since `since` as JSON, returns the file path"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    finished = datetime.now()
+    path = os.path.join(directory, f"run-{finished.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as file:
+        json.dump({"finished_at": finished.isoformat(), **REGISTRY.report(since)}, file, indent=2)
+    return path
+
+
+# Serves /metrics in the Prometheus text format on localhost, returns the runner to clean up
+async def start_metrics_server(port: int = METRICS_PORT):
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return runner
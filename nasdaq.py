@@ -1,22 +1,27 @@
 import requests
-import aiohttp
+from fetcher import get_scheduler, NASDAQ_BASE_URL
+from metrics import timed
+
+NASDAQ_SCREENER_URL = NASDAQ_BASE_URL + "/api/screener/stocks?tableonly=true&offset=0&download=true"
+
 # Async function to fetch NASDAQ tickers (optional)
-async def get_nasdaq_tickers():
-    url = "https://api.nasdaq.com/api/screener/stocks?tableonly=true&offset=0&download=true"
+@timed("get_nasdaq_tickers")
+async def get_nasdaq_tickers(scheduler=None):
+    url = NASDAQ_SCREENER_URL
     headers = {"User-Agent": "Mozilla/5.0"}
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                tickers = [row["symbol"] for row in data["data"]["rows"]]
-                return tickers
-            else:
-                print(f"Failed to fetch NASDAQ tickers: {response.status}")
-                return []
+    scheduler = scheduler or get_scheduler()
+    status, data = await scheduler.get(url, headers=headers)
+    if status == 200 and data:
+        tickers = [row["symbol"] for row in data["data"]["rows"]]
+        return tickers
+    else:
+        print(f"Failed to fetch NASDAQ tickers: {status}")
+        return []
 # Optional: Fetch all tickers from NASDAQ API (uncomment to use)
+@timed("get_nasdaq_tickers_sync")
 def get_nasdaq_tickers_sync():
-    url = "https://api.nasdaq.com/api/screener/stocks?tableonly=true&offset=0&download=true"
+    url = NASDAQ_SCREENER_URL
     headers = {"User-Agent": "Mozilla/5.0"}  # NASDAQ API requires a user-agent
     response = requests.get(url, headers=headers)
     
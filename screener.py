@@ -0,0 +1,307 @@
+import re
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from bars import compute_rsi, fill_gaps
+
+
+DEFAULT_TIMEFRAME = "day"
+# Timeframes the bar store can supply, rules on any other frame are rejected when the screener is built
+TIMEFRAMES = ("day",)
+
+# Indicator names look like RSI14, SMA200, EMA50, STOCHRSI14 or CLOSE, optionally prefixed by a timeframe (hour.RSI14)
+INDICATOR_PATTERN = re.compile(r"^(?:(?P<frame>[a-z]+)\.)?(?P<name>STOCHRSI|RSI|SMA|EMA|CLOSE)(?P<window>\d*)$")
+TOKEN_PATTERN = re.compile(r"\s*(?:(\d+(?:\.\d+)?)|([A-Za-z_][\w.]*)|(<=|>=|<|>|\(|\)))")
+COMPARISONS = {"<", "<=", ">", ">=", "crosses_above", "crosses_below"}
+KEYWORDS = {"and", "or", "not"} | COMPARISONS
+
+
+def sma(closes: np.ndarray, window: int) -> np.ndarray:
+    filled = fill_gaps(np.asarray(closes, dtype=float))
+    result = np.full(filled.shape, np.nan)
+    if filled.shape[1] >= window:
+        result[:, window - 1:] = sliding_window_view(filled, window, axis=1).mean(axis=2)
+    return result
+
+
+def ema(closes: np.ndarray, window: int) -> np.ndarray:
+    filled = fill_gaps(np.asarray(closes, dtype=float))
+    result = np.full(filled.shape, np.nan)
+    if filled.shape[1] < window:
+        return result
+    alpha = 2.0 / (window + 1)
+    # Seeded with the SMA of the first window, then smoothed one day at a time for every ticker at once
+    value = filled[:, :window].mean(axis=1)
+    result[:, window - 1] = value
+    for t in range(window, filled.shape[1]):
+        value = alpha * filled[:, t] + (1 - alpha) * value
+        result[:, t] = value
+    return result
+
+
+def stoch_rsi(closes: np.ndarray, window: int) -> np.ndarray:
+    rsi = compute_rsi(closes, window)
+    result = np.full(rsi.shape, np.nan)
+    if rsi.shape[1] >= window:
+        windows = sliding_window_view(rsi, window, axis=1)
+        low, high = windows.min(axis=2), windows.max(axis=2)
+        # Undefined while the window still holds warm-up NaNs (min/max are NaN) or the RSI is flat
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result[:, window - 1:] = np.where(high > low, (rsi[:, window - 1:] - low) / (high - low) * 100, np.nan)
+        result[np.isnan(rsi)] = np.nan
+    return result
+
+
+def compute_indicator(name: str, window: int, closes: np.ndarray) -> np.ndarray:
+    if name == "CLOSE":
+        return fill_gaps(np.asarray(closes, dtype=float))
+    if name == "RSI":
+        return compute_rsi(closes, window)
+    if name == "STOCHRSI":
+        return stoch_rsi(closes, window)
+    if name == "SMA":
+        return sma(closes, window)
+    return ema(closes, window)
+
+
+def _tokenize(expression: str) -> list:
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Invalid rule near '{expression[position:]}'")
+        number, word, symbol = match.groups()
+        if number is not None:
+            tokens.append(("num", float(number)))
+        elif word is not None:
+            tokens.append(("op", word.lower()) if word.lower() in KEYWORDS else ("ind", word))
+        else:
+            tokens.append(("op", symbol))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive descent parser for rules such as "RSI14 < 30 and CLOSE > SMA200" """
+
+    def __init__(self, expression: str):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        node = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token {self.tokens[self.position][1]}")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _take(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Rule ended unexpectedly")
+        self.position += 1
+        return token
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ("op", "or"):
+            self._take()
+            node = ("or", node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == ("op", "and"):
+            self._take()
+            node = ("and", node, self._not())
+        return node
+
+    def _not(self):
+        if self._peek() == ("op", "not"):
+            self._take()
+            return ("not", self._not())
+        if self._peek() == ("op", "("):
+            self._take()
+            node = self._or()
+            if self._take() != ("op", ")"):
+                raise ValueError("Missing closing parenthesis")
+            return node
+        left = self._operand()
+        kind, op = self._take()
+        if kind != "op" or op not in COMPARISONS:
+            raise ValueError(f"Expected a comparison, got {op}")
+        return ("cmp", op, left, self._operand())
+
+    def _operand(self):
+        kind, value = self._take()
+        if kind == "num":
+            return ("num", value)
+        if kind == "ind":
+            match = INDICATOR_PATTERN.match(value)
+            if not match:
+                raise ValueError(f"Unknown indicator {value}")
+            name = match.group("name")
+            window = int(match.group("window") or (1 if name == "CLOSE" else 14))
+            frame = match.group("frame") or DEFAULT_TIMEFRAME
+            return ("ind", value, frame, name, window)
+        raise ValueError(f"Expected an indicator or number, got {value}")
+
+
+def _indicators(node) -> list:
+    """Indicator operands of a rule, in the order they are written"""
+    if node[0] == "ind":
+        return [node]
+    if node[0] == "num":
+        return []
+    if node[0] == "cmp":
+        return _indicators(node[2]) + _indicators(node[3])
+    return [operand for child in node[1:] for operand in _indicators(child)]
+
+
+# Columnar screening output, one row per (ticker, rule) match
+class ScreenResult:
+    def __init__(self, columns: dict, primary: dict, evaluations: dict = None, directions: dict = None,
+                 timestamp: int = 0):
+        self.columns = columns
+        self.primary = primary  # rule name -> indicator shown next to the ticker
+        self.evaluations = evaluations or {}  # rule name -> (tickers, matched, primary value) over every ticker
+        self.directions = directions or {}  # rule name -> Screener.direction
+        self.timestamp = timestamp  # latest bar the rules were evaluated on
+
+    def __len__(self):
+        return len(self.columns["ticker"])
+
+    def rows(self) -> list:
+        names = list(self.columns)
+        return [dict(zip(names, values)) for values in zip(*(self.columns[name] for name in names))]
+
+    def to_perspectives(self) -> list:
+        """(ticker, value, rule, timestamp, indicator) tuples for the Discord webhook"""
+        perspectives = []
+        for row in self.rows():
+            indicator = self.primary.get(row["rule"])
+            value = float(row[indicator]) if indicator else float("nan")
+            perspectives.append((str(row["ticker"]), value, row["rule"], int(row["timestamp"]), indicator or "Value"))
+        return perspectives
+
+
+# Evaluates named declarative rules over every ticker in one vectorized pass per indicator
+class Screener:
+    def __init__(self, rules: dict, timeframes: tuple = TIMEFRAMES):
+        self.rules = {}
+        for name, expression in rules.items():
+            try:
+                self.rules[name] = _Parser(expression).parse()
+            except ValueError as e:
+                raise ValueError(f"Rule '{name}': {str(e)}") from None
+        self.indicators = {}
+        for name, tree in self.rules.items():
+            for operand in _indicators(tree):
+                if operand[2] not in timeframes:
+                    raise ValueError(
+                        f"Rule '{name}' uses {operand[1]}, but only {', '.join(timeframes)} bars are available"
+                    )
+                self.indicators.setdefault(operand[1], operand)
+
+    def direction(self, rule: str) -> int:
+        """-1 when lower values of the rule's first indicator are more extreme, 1 when higher are, else 0"""
+        node = self.rules[rule]
+        while node[0] in ("and", "or"):
+            node = node[1]
+        if node[0] != "cmp" or node[2][0] != "ind":
+            return 0
+        return {"<": -1, "<=": -1, ">": 1, ">=": 1}.get(node[1], 0)
+
+    @property
+    def lookback(self) -> int:
+        """Bars of history the longest indicator needs, plus one for crossovers"""
+        needed = [window * (2 if name == "STOCHRSI" else 1) + 1 for _, _, _, name, window in self.indicators.values()]
+        return max(needed, default=1) + 1
+
+    def _evaluate(self, node, series: dict, size: int) -> np.ndarray:
+        kind = node[0]
+        if kind == "and":
+            return self._evaluate(node[1], series, size) & self._evaluate(node[2], series, size)
+        if kind == "or":
+            return self._evaluate(node[1], series, size) | self._evaluate(node[2], series, size)
+        if kind == "not":
+            return ~self._evaluate(node[1], series, size)
+        _, op, left, right = node
+
+        def values(operand, offset):
+            if operand[0] == "num":
+                return np.full(size, operand[1])
+            column = series[operand[1]]
+            return column[:, offset] if column.shape[1] >= -offset else np.full(size, np.nan)
+
+        with np.errstate(invalid="ignore"):
+            now_left, now_right = values(left, -1), values(right, -1)
+            if op == "<":
+                return now_left < now_right
+            if op == "<=":
+                return now_left <= now_right
+            if op == ">":
+                return now_left > now_right
+            if op == ">=":
+                return now_left >= now_right
+            before_left, before_right = values(left, -2), values(right, -2)
+            if op == "crosses_above":
+                return (before_left <= before_right) & (now_left > now_right)
+            return (before_left >= before_right) & (now_left < now_right)
+
+    def run(self, tickers: list, frames: dict) -> ScreenResult:
+        """`frames` maps a timeframe name to (timestamps, closes), closes being a tickers x bars matrix"""
+        size = len(tickers)
+        series = {}
+        for key, (_, _, frame, name, window) in self.indicators.items():
+            if frame not in frames:
+                raise ValueError(f"No {frame} bars to compute {key}")
+            series[key] = compute_indicator(name, window, frames[frame][1])
+
+        first_frame = frames.get(DEFAULT_TIMEFRAME) or next(iter(frames.values()))
+        timestamp = int(first_frame[0][-1]) if len(first_frame[0]) else 0
+        tickers = np.asarray(tickers)
+        latest = {key: (column[:, -1] if column.shape[1] else np.full(size, np.nan)) for key, column in series.items()}
+
+        primary = {}
+        for rule, tree in self.rules.items():
+            operands = _indicators(tree)
+            if operands:
+                primary[rule] = operands[0][1]
+
+        matched_tickers, matched_rules, matched_rows = [], [], []
+        evaluations = {}
+        for rule, tree in self.rules.items():
+            matched = self._evaluate(tree, series, size)
+            values = latest[primary[rule]] if rule in primary else np.full(size, np.nan)
+            evaluations[rule] = (tickers, matched, values)
+            rows = np.flatnonzero(matched)
+            matched_tickers.append(tickers[rows])
+            matched_rules.append(np.full(len(rows), rule, dtype=object))
+            matched_rows.append(rows)
+        rows = np.concatenate(matched_rows) if matched_rows else np.array([], dtype=int)
+
+        columns = {
+            "ticker": np.concatenate(matched_tickers).astype(str) if matched_tickers else np.array([], dtype=str),
+            "rule": np.concatenate(matched_rules) if matched_rules else np.array([], dtype=object),
+            "timestamp": np.full(len(rows), timestamp, dtype=np.int64),
+        }
+        for key, column in latest.items():
+            columns[key] = column[rows]
+        directions = {rule: self.direction(rule) for rule in self.rules}
+        return ScreenResult(columns, primary, evaluations, directions, timestamp)
+
+
+def parse_rules(text: str) -> dict:
+    """Parses "Name: expression; Name: expression" as used by the SCREEN_RULES setting"""
+    rules = {}
+    for entry in (text or "").split(";"):
+        if not entry.strip():
+            continue
+        name, separator, expression = entry.partition(":")
+        if not separator:
+            raise ValueError(f"Rule '{entry.strip()}' needs a name, e.g. 'Dip: RSI14 < 30 and CLOSE > SMA200'")
+        rules[name.strip()] = expression.strip()
+    return rules
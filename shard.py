@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import threading
+import multiprocessing
+import dotenv
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fetcher import RequestScheduler, HOST_RATE_LIMITS, get_scheduler
+
+
+dotenv.load_dotenv()
+
+# Worker processes (or hosts, with SHARD_QUEUE_DIR) scanning the universe in parallel, 0 disables sharding
+SHARD_WORKERS: int = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_SIZE: int = int(os.getenv("SHARD_SIZE", "250"))
+SHARD_MAX_ATTEMPTS: int = int(os.getenv("SHARD_MAX_ATTEMPTS", "3"))
+# Shared directory used as the queue for workers on other hosts, local processes are used when empty
+SHARD_QUEUE_DIR: str = os.getenv("SHARD_QUEUE_DIR", "")
+# Seconds a claimed shard may go without a result or a lease renewal before it is handed to another worker,
+# workers renew their lease while they scan, so this only needs to cover a worker that died
+SHARD_LEASE_SECONDS: float = float(os.getenv("SHARD_LEASE_SECONDS", "300"))
+SHARD_TIMEOUT_SECONDS: float = float(os.getenv("SHARD_TIMEOUT_SECONDS", "1800"))
+
+
+def split_shards(tickers: list, size: int = SHARD_SIZE) -> list:
+    return [tickers[i:i + size] for i in range(0, len(tickers), size)]
+
+
+async def _scan(tickers: list, rate_share: float) -> tuple:
+    from main import get_latest_rsi
+
+    # Every worker gets its share of the plan's rate limit so the total stays within it
+    limits = {
+        host: (rate * rate_share, max(1, int(burst * rate_share)))
+        for host, (rate, burst) in HOST_RATE_LIMITS.items()
+    }
+    scheduler = RequestScheduler(host_limits=limits)
+    try:
+        results = await asyncio.gather(*(get_latest_rsi(scheduler, ticker) for ticker in tickers))
+    finally:
+        await scheduler.close()
+    stats = scheduler.stats
+    return list(results), (stats.succeeded, stats.retried, stats.failed)
+
+
+# Worker entry point, scans one shard on its own event loop and connection pool
+def scan_shard(tickers: list, rate_share: float = 1.0) -> tuple:
+    """Returns (results, (succeeded, retried, failed)), results shaped like get_latest_rsi"""
+    return asyncio.run(_scan(tickers, rate_share))
+
+
+def _shard_failed(results: list) -> bool:
+    # A shard where not a single ticker came back points at the worker, not the tickers
+    return bool(results) and all(rsi is None for _, rsi, _ in results)
+
+
+def _new_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned, not forked, so a worker never inherits a lock held by the heatmap, resolver or event loop threads
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _add_stats(stats: tuple):
+    totals = get_scheduler().stats
+    totals.succeeded += stats[0]
+    totals.retried += stats[1]
+    totals.failed += stats[2]
+
+
+# Scans the shards in a pool of worker processes, yielding results shard by shard as they finish
+async def scan_with_processes(tickers: list, workers: int = SHARD_WORKERS, shard_size: int = SHARD_SIZE):
+    loop = asyncio.get_running_loop()
+    shards = split_shards(tickers, shard_size)
+    rate_share = 1.0 / workers
+    pool = _new_pool(workers)
+
+    def submit(index):
+        return loop.run_in_executor(pool, scan_shard, shards[index], rate_share)
+
+    pending = {submit(index): (index, 0, pool) for index in range(len(shards))}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                index, attempts, shard_pool = pending.pop(future)
+                try:
+                    results, stats = future.result()
+                    _add_stats(stats)
+                    failed = _shard_failed(results)
+                except Exception as e:
+                    print(f"Shard {index} failed: {type(e).__name__} {str(e)}")
+                    results, failed = None, True
+                    if isinstance(e, BrokenProcessPool) and shard_pool is pool:
+                        # A worker died and took the pool down, start a fresh one for the re-queued shards
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool = _new_pool(workers)
+                if not failed:
+                    for result in results:
+                        yield result
+                elif attempts + 1 < SHARD_MAX_ATTEMPTS:
+                    print(f"Re-queueing shard {index} ({len(shards[index])} tickers)")
+                    pending[submit(index)] = (index, attempts + 1, pool)
+                else:
+                    print(f"Giving up on shard {index} after {SHARD_MAX_ATTEMPTS} attempts")
+                    if results:
+                        for result in results:
+                            yield result
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Directory based work queue, any host that can see the directory can run `python shard.py worker`
+class ShardQueue:
+    def __init__(self, directory: str = SHARD_QUEUE_DIR):
+        self.directory = directory
+        for state in ("pending", "claimed", "done"):
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def _path(self, state: str, shard_id: str) -> str:
+        return os.path.join(self.directory, state, f"{shard_id}.json")
+
+    def _write(self, path: str, data: dict):
+        # Write then rename, so readers never see a half written file
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(data, file)
+        os.replace(temporary, path)
+
+    def put(self, shard_id: str, job: dict):
+        self._write(self._path("pending", shard_id), job)
+
+    def claim(self) -> tuple:
+        """Atomically takes the oldest pending shard, returns (shard_id, job) or (None, None)"""
+        for name in sorted(os.listdir(os.path.join(self.directory, "pending"))):
+            if not name.endswith(".json"):
+                continue
+            shard_id = name[:-5]
+            claimed = self._path("claimed", shard_id)
+            try:
+                os.rename(self._path("pending", shard_id), claimed)
+            except OSError:
+                continue  # another worker got it first
+            os.utime(claimed)
+            with open(claimed) as file:
+                return shard_id, json.load(file)
+        return None, None
+
+    def renew(self, shard_id: str) -> bool:
+        """Extends the lease on a claimed shard, False once it is no longer claimed"""
+        try:
+            os.utime(self._path("claimed", shard_id))
+        except OSError:
+            return False
+        return True
+
+    def complete(self, shard_id: str, result: dict):
+        if not os.path.exists(self._path("claimed", shard_id)) and not os.path.exists(self._path("pending", shard_id)):
+            return  # discarded by the coordinator, nobody will read the result
+        self._write(self._path("done", shard_id), result)
+        try:
+            os.remove(self._path("claimed", shard_id))
+        except OSError:
+            pass
+
+    def take_result(self, shard_id: str) -> dict:
+        path = self._path("done", shard_id)
+        try:
+            with open(path) as file:
+                result = json.load(file)
+        except (OSError, ValueError):
+            return None
+        os.remove(path)
+        return result
+
+    def discard(self, shard_ids: list):
+        """Removes every file of the given shards, so no worker picks them up later"""
+        for shard_id in shard_ids:
+            for state in ("pending", "claimed", "done"):
+                try:
+                    os.remove(self._path(state, shard_id))
+                except OSError:
+                    pass
+
+    def requeue_expired(self, lease_seconds: float = SHARD_LEASE_SECONDS) -> list:
+        """Moves shards claimed longer than the lease back to pending, returns their ids"""
+        expired = []
+        claimed_dir = os.path.join(self.directory, "claimed")
+        for name in os.listdir(claimed_dir):
+            path = os.path.join(claimed_dir, name)
+            try:
+                if not name.endswith(".json") or time.time() - os.path.getmtime(path) < lease_seconds:
+                    continue
+                os.rename(path, self._path("pending", name[:-5]))
+                expired.append(name[:-5])
+            except OSError:
+                continue
+        return expired
+
+
+# Hands the shards to workers through the queue directory, yielding results as shards come back
+async def scan_with_queue(tickers: list, directory: str = SHARD_QUEUE_DIR, shard_size: int = SHARD_SIZE,
+                          workers: int = SHARD_WORKERS):
+    queue = ShardQueue(directory)
+    run_id = time.strftime("%Y%m%d%H%M%S")
+    shards = {f"{run_id}-{index:05d}": shard for index, shard in enumerate(split_shards(tickers, shard_size))}
+    attempts = dict.fromkeys(shards, 0)
+    for shard_id, shard in shards.items():
+        queue.put(shard_id, {"tickers": shard, "rate_share": 1.0 / max(1, workers)})
+
+    deadline = time.monotonic() + SHARD_TIMEOUT_SECONDS
+    try:
+        while attempts and time.monotonic() < deadline:
+            for shard_id in list(attempts):
+                result = queue.take_result(shard_id)
+                if result is None:
+                    continue
+                results = [tuple(row) for row in result["results"]]
+                _add_stats(result["stats"])
+                if _shard_failed(results) and attempts[shard_id] + 1 < SHARD_MAX_ATTEMPTS:
+                    print(f"Re-queueing shard {shard_id} ({len(results)} tickers)")
+                    attempts[shard_id] += 1
+                    queue.put(shard_id, {"tickers": shards[shard_id], "rate_share": 1.0 / max(1, workers)})
+                    continue
+                del attempts[shard_id]
+                for row in results:
+                    yield row
+            for shard_id in queue.requeue_expired():
+                print(f"Shard {shard_id} lease expired, re-queued")
+            await asyncio.sleep(0.5)
+        if attempts:
+            print(f"Timed out waiting for {len(attempts)} shards")
+    finally:
+        # Leftover shards of this run would otherwise be scanned by workers during later runs
+        queue.discard(list(attempts))
+
+
+# Yields get_latest_rsi shaped results for every ticker, using the queue directory when one is configured
+def scan_sharded(tickers: list, workers: int = SHARD_WORKERS, shard_size: int = SHARD_SIZE):
+    if SHARD_QUEUE_DIR:
+        return scan_with_queue(tickers, SHARD_QUEUE_DIR, shard_size, workers)
+    return scan_with_processes(tickers, workers, shard_size)
+
+
+# Worker loop for other hosts: claims shards from the queue directory until stopped
+def run_worker(directory: str = SHARD_QUEUE_DIR):
+    queue = ShardQueue(directory)
+    print(f"Waiting for shards in {directory}")
+    while True:
+        shard_id, job = queue.claim()
+        if shard_id is None:
+            time.sleep(1)
+            continue
+        print(f"Scanning shard {shard_id} ({len(job['tickers'])} tickers)")
+        # Keeps the lease fresh while scanning, a slow shard at a low rate limit can outlast SHARD_LEASE_SECONDS
+        scanning = threading.Event()
+
+        def renew_lease():
+            while not scanning.wait(max(1.0, min(60.0, SHARD_LEASE_SECONDS / 3))):
+                if not queue.renew(shard_id):
+                    return
+
+        renewer = threading.Thread(target=renew_lease, daemon=True)
+        renewer.start()
+        try:
+            results, stats = scan_shard(job["tickers"], job.get("rate_share", 1.0))
+        except Exception as e:
+            # Left claimed, the coordinator re-queues it once the lease runs out
+            print(f"Shard {shard_id} failed: {type(e).__name__} {str(e)}")
+            continue
+        finally:
+            scanning.set()
+            renewer.join()
+        queue.complete(shard_id, {"results": results, "stats": stats})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "worker":
+        print("Usage: python shard.py worker [queue directory]")
+        sys.exit(1)
+    run_worker(sys.argv[2] if len(sys.argv) > 2 else SHARD_QUEUE_DIR)
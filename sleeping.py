@@ -1,33 +1,231 @@
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 import asyncio
+import json
+import os
+import dotenv
 
-# Function to calculate seconds until next 9:46 AM
-def seconds_until_946am():
-    now = datetime.now()
-    target = now.replace(hour=9, minute=46, second=0, microsecond=0)
-    
-    # If it's past 9:46 AM today, schedule for tomorrow
-    if now > target:
-        target += timedelta(days=1)
-    
-    # Calculate seconds until the target time
-    delta = (target - now).total_seconds()
-    return delta if delta > 0 else delta + 86400  # 86400 seconds = 1 day
-
-# Async scheduler function
-async def run_daily_at_946am(func):
+
+dotenv.load_dotenv()
+
+EASTERN = ZoneInfo("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+EARLY_CLOSE = time(13, 0)
+
+# Comma separated run times: open+N / open-N / close+N / close-N in minutes, or hourly during the session
+SCHEDULE: str = os.getenv("SCHEDULE", "open+16")
+# Seconds before each run to refresh the universe, connection pool and indicator state
+PREWARM_SECONDS: float = float(os.getenv("PREWARM_SECONDS", "120"))
+# A run missed while the bot was down is still made if it is at most this many minutes late
+CATCH_UP_MINUTES: float = float(os.getenv("CATCH_UP_MINUTES", "30"))
+SCHEDULE_STATE_PATH = "data/schedule.json"
+
+
+def _observed(day: date) -> date:
+    """Holidays on a Saturday are observed the Friday before, on a Sunday the Monday after"""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """n-th given weekday of the month, n = -1 for the last one"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> date:
+    # Anonymous Gregorian algorithm
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 19 * l) // 433
+    month = (h + l - 7 * m + 90) // 25
+    return date(year, month, (h + l - 7 * m + 33 * month + 19) % 32)
+
+
+@lru_cache(maxsize=None)
+def market_holidays(year: int) -> frozenset:
+    """NYSE/NASDAQ full day closures for the year"""
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),  # Presidents' Day
+        _easter(year) - timedelta(days=2),  # Good Friday
+        _nth_weekday(year, 5, 0, -1),  # Memorial Day
+        _observed(date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),  # Labor Day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        _observed(date(year, 12, 25)),
+    }
+    # New Year's Day on a Saturday is not observed on the Friday before
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        holidays.add(_observed(new_year))
+    if year >= 2022:
+        holidays.add(_observed(date(year, 6, 19)))  # Juneteenth
+    return frozenset(holidays)
+
+
+@lru_cache(maxsize=None)
+def early_closes(year: int) -> frozenset:
+    """Sessions that close at 1:00 PM"""
+    closes = {_nth_weekday(year, 11, 3, 4) + timedelta(days=1)}  # Day after Thanksgiving
+    for day in (date(year, 7, 3), date(year, 12, 24)):
+        if day.weekday() < 5 and day not in market_holidays(year):
+            closes.add(day)
+    return frozenset(closes)
+
+
+def is_trading_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in market_holidays(day.year)
+
+
+def session_hours(day: date) -> tuple:
+    """(open, close) of the session as US/Eastern datetimes"""
+    close = EARLY_CLOSE if day in early_closes(day.year) else MARKET_CLOSE
+    return datetime.combine(day, MARKET_OPEN, EASTERN), datetime.combine(day, close, EASTERN)
+
+
+def parse_schedule(text: str) -> list:
+    """Parses SCHEDULE entries, e.g. "open-30,open+16,hourly,close+5" """
+    cadences = []
+    for entry in text.split(","):
+        entry = entry.strip().lower()
+        if not entry:
+            continue
+        if entry == "hourly":
+            cadences.append((entry, None, 0))
+            continue
+        for anchor in ("open", "close"):
+            if entry.startswith(anchor):
+                offset = entry[len(anchor):] or "+0"
+                try:
+                    cadences.append((entry, anchor, int(offset)))
+                except ValueError:
+                    raise ValueError(f"Invalid schedule entry '{entry}'")
+                break
+        else:
+            raise ValueError(f"Invalid schedule entry '{entry}'")
+    return cadences
+
+
+def session_triggers(day: date, cadences: list) -> list:
+    """Sorted (time, cadence name) run times for one trading day"""
+    open_at, close_at = session_hours(day)
+    triggers = []
+    for name, anchor, minutes in cadences:
+        if anchor is None:
+            at = open_at + timedelta(hours=1)
+            while at <= close_at:
+                triggers.append((at, name))
+                at += timedelta(hours=1)
+        else:
+            triggers.append(((open_at if anchor == "open" else close_at) + timedelta(minutes=minutes), name))
+    return sorted(triggers)
+
+
+def next_trigger(after: datetime, cadences: list) -> tuple:
+    """First (time, cadence name) strictly after `after`"""
+    day = after.astimezone(EASTERN).date()
+    for _ in range(15):
+        if is_trading_day(day):
+            for at, name in session_triggers(day, cadences):
+                if at > after:
+                    return at, name
+        day += timedelta(days=1)
+    raise ValueError("No trading session in the next two weeks")
+
+
+def last_trigger(before: datetime, cadences: list) -> tuple:
+    """Latest (time, cadence name) at or before `before`, or (None, None)"""
+    day = before.astimezone(EASTERN).date()
+    for _ in range(15):
+        if is_trading_day(day):
+            for at, name in reversed(session_triggers(day, cadences)):
+                if at <= before:
+                    return at, name
+        day -= timedelta(days=1)
+    return None, None
+
+
+async def _sleep_until(target: datetime):
+    # Short sleeps against the wall clock, so suspend or clock changes do not make the run drift
     while True:
-        # Calculate delay until next 9:46 AM
-        delay = seconds_until_946am()
-        print(f"Waiting {delay:.2f} seconds or {delay//3600:.2f} hours until next run at 9:46 AM...")
-        await asyncio.sleep(delay)
-        
-        # Run the main logic
+        remaining = (target - datetime.now(EASTERN)).total_seconds()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, 60))
+
+
+# Runs `func` at every cadence of each trading session, calling `prewarm` ahead of each run
+class MarketScheduler:
+    def __init__(self, func, prewarm=None, schedule: str = SCHEDULE, prewarm_seconds: float = PREWARM_SECONDS,
+                 catch_up_minutes: float = CATCH_UP_MINUTES, state_path: str = SCHEDULE_STATE_PATH):
+        self.func = func
+        self.prewarm = prewarm
+        self.cadences = parse_schedule(schedule)
+        self.prewarm_seconds = prewarm_seconds
+        self.catch_up_minutes = catch_up_minutes
+        self.state_path = state_path
+
+    def _last_run(self) -> datetime:
+        try:
+            with open(self.state_path) as file:
+                return datetime.fromisoformat(json.load(file)["last_run"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_last_run(self, at: datetime):
+        directory = os.path.dirname(self.state_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.state_path, "w") as file:
+            json.dump({"last_run": at.isoformat()}, file)
+
+    async def _run(self, at: datetime, name: str):
+        print(f"Running {name} for {at.strftime('%Y-%m-%d %H:%M %Z')}")
         try:
-            await func()
+            await self.func()
         except Exception as e:
             print(f"Error during execution: {str(e)}")
-        
-        # Wait briefly before recalculating to avoid immediate re-run
-        await asyncio.sleep(60)  # Sleep 1 minute to ensure we pass 9:46 AM
\ No newline at end of file
+        self._save_last_run(at)
+
+    async def _catch_up(self):
+        """Makes the most recent run missed while the bot was down, if it is recent enough"""
+        last_run = self._last_run()
+        now = datetime.now(EASTERN)
+        missed_at, name = last_trigger(now, self.cadences)
+        if last_run is None or missed_at is None or missed_at <= last_run:
+            return
+        if now - missed_at <= timedelta(minutes=self.catch_up_minutes):
+            print(f"Catching up missed {name} run")
+            await self._run(missed_at, name)
+        else:
+            print(f"Skipping missed {name} run from {missed_at.strftime('%Y-%m-%d %H:%M %Z')}")
+            self._save_last_run(missed_at)
+
+    async def run_forever(self):
+        await self._catch_up()
+        while True:
+            at, name = next_trigger(datetime.now(EASTERN), self.cadences)
+            delay = (at - datetime.now(EASTERN)).total_seconds()
+            print(f"Waiting {delay:.2f} seconds or {delay / 3600:.2f} hours until {name} at {at.strftime('%Y-%m-%d %H:%M %Z')}...")
+            if self.prewarm is not None:
+                await _sleep_until(at - timedelta(seconds=self.prewarm_seconds))
+                try:
+                    await self.prewarm()
+                except Exception as e:
+                    print(f"Error during pre-warm: {str(e)}")
+            await _sleep_until(at)
+            await self._run(at, name)
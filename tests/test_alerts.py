@@ -0,0 +1,118 @@
+import asyncio
+from alerts import AlertState, AlertBatcher, NEW, ESCALATED, EXIT
+
+
+def _alert(ticker, value, rule, event):
+    return ticker, value, rule, 0, "RSI", event
+
+
+def test_new_escalated_and_exit(tmp_path):
+    path = str(tmp_path / "alerts.db")
+    state = AlertState(path, escalation_step=5)
+    assert state.observe("A", "Oversold", 25, True, -1) == NEW
+    assert state.observe("B", "Oversold", 40, False, -1) is None
+    state.delivered([_alert("A", 25, "Oversold", NEW)])
+    state.close()
+
+    state = AlertState(path, escalation_step=5)
+    assert state.observe("A", "Oversold", 22, True, -1) is None  # moved less than one step
+    assert state.observe("A", "Oversold", 19, True, -1) == ESCALATED
+    state.delivered([_alert("A", 19, "Oversold", ESCALATED)])
+    assert state.observe("A", "Oversold", 35, False, -1) == EXIT
+    state.close()
+
+    state = AlertState(path)
+    assert state.active == {("A", "Oversold"): 19}
+    state.close()
+
+
+def test_undelivered_alerts_are_sent_again(tmp_path):
+    path = str(tmp_path / "alerts.db")
+    state = AlertState(path)
+    assert state.observe("A", "Oversold", 25, True, -1) == NEW
+    state.close()
+    state = AlertState(path)
+    assert state.observe("A", "Oversold", 25, True, -1) == NEW
+    # The delivery queue reports back after the scan has closed the state
+    state.close()
+    state.delivered([_alert("A", 25, "Oversold", NEW)])
+    assert AlertState(path).observe("A", "Oversold", 25, True, -1) is None
+
+
+def test_prune_keeps_unavailable_tickers(tmp_path):
+    path = str(tmp_path / "alerts.db")
+    state = AlertState(path)
+    state.delivered([_alert(ticker, 25, "Oversold", NEW) for ticker in ("A", "B", "C")])
+    state.close()
+
+    state = AlertState(path)
+    state.observe("A", "Oversold", 25, True, -1)
+    assert state.prune(keep={"C"}) == 1  # B left the universe, C had no data this run
+    state.close()
+    assert set(AlertState(path).active) == {("A", "Oversold"), ("C", "Oversold")}
+
+
+def test_rollback_discards_pruning(tmp_path):
+    path = str(tmp_path / "alerts.db")
+    state = AlertState(path)
+    state.delivered([_alert("A", 25, "Oversold", NEW)])
+    state.close()
+    state = AlertState(path)
+    state.prune()
+    state.rollback()
+    assert set(AlertState(path).active) == {("A", "Oversold")}
+
+
+def test_batcher_flushes_full_batches_and_on_timer():
+    sent, delivered = [], []
+
+    async def send(batch, on_delivered):
+        sent.append(batch)
+        on_delivered()
+
+    async def scenario():
+        batcher = AlertBatcher(send, flush_seconds=0.05, batch_size=2, on_delivered=delivered.append)
+        await batcher.add("a")
+        await batcher.add("b")
+        assert sent == [["a", "b"]]
+        await batcher.add("c")
+        await asyncio.sleep(0.1)
+        assert sent == [["a", "b"], ["c"]]
+        await batcher.close()
+
+    asyncio.run(scenario())
+    assert delivered == [["a", "b"], ["c"]]
+
+
+def test_batcher_close_cancels_the_timer_and_flushes():
+    sent = []
+
+    async def send(batch):
+        sent.append(batch)
+
+    async def scenario():
+        batcher = AlertBatcher(send, flush_seconds=60)
+        await batcher.add("a")
+        timer = batcher.timer
+        await batcher.close()
+        assert timer.cancelled()
+
+    asyncio.run(scenario())
+    assert sent == [["a"]]
+
+
+def test_batcher_close_waits_for_a_send_in_progress():
+    sent = []
+
+    async def send(batch):
+        await asyncio.sleep(0.05)
+        sent.append(batch)
+
+    async def scenario():
+        batcher = AlertBatcher(send, flush_seconds=0.01)
+        await batcher.add("a")
+        await asyncio.sleep(0.02)  # timer fired, send in progress
+        await batcher.close()
+
+    asyncio.run(scenario())
+    assert sent == [["a"]]
@@ -0,0 +1,49 @@
+import numpy as np
+from bars import compute_rsi, fill_gaps
+
+
+def _reference_rsi(closes: list, window: int = 14) -> list:
+    deltas = [b - a for a, b in zip(closes, closes[1:])]
+    gains = [max(d, 0) for d in deltas]
+    losses = [max(-d, 0) for d in deltas]
+    avg_gain = sum(gains[:window]) / window
+    avg_loss = sum(losses[:window]) / window
+    rsi = [None] * window
+    for t in range(window, len(deltas) + 1):
+        if t > window:
+            avg_gain = (avg_gain * (window - 1) + gains[t - 1]) / window
+            avg_loss = (avg_loss * (window - 1) + losses[t - 1]) / window
+        rsi.append(100.0 if avg_loss == 0 else 100 - 100 / (1 + avg_gain / avg_loss))
+    return rsi
+
+
+def test_compute_rsi_matches_wilder_reference():
+    rng = np.random.default_rng(7)
+    closes = 100 + np.cumsum(rng.normal(0, 1, (3, 40)), axis=1)
+    rsi = compute_rsi(closes)
+    for row in range(3):
+        expected = _reference_rsi(closes[row].tolist())
+        assert np.isnan(rsi[row, :14]).all()
+        np.testing.assert_allclose(rsi[row, 14:], expected[14:])
+
+
+def test_compute_rsi_without_losses_is_100():
+    closes = np.arange(1, 31, dtype=float)[None, :]
+    assert compute_rsi(closes)[0, -1] == 100.0
+
+
+def test_compute_rsi_needs_more_than_window_bars():
+    assert np.isnan(compute_rsi(np.ones((2, 14)))).all()
+    closes = np.full((1, 30), np.nan)
+    closes[0, -10:] = np.arange(10)
+    assert np.isnan(compute_rsi(closes)).all()
+
+
+def test_missing_closes_count_as_unchanged():
+    closes = np.array([[np.nan, 1.0, np.nan, 3.0, np.nan]])
+    np.testing.assert_array_equal(fill_gaps(closes), [[1.0, 1.0, 1.0, 3.0, 3.0]])
+    gappy = 100 + np.arange(30, dtype=float)
+    gappy[20] = np.nan
+    filled = gappy.copy()
+    filled[20] = filled[19]
+    np.testing.assert_allclose(compute_rsi(gappy[None, :]), compute_rsi(filled[None, :]))
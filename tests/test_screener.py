@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from screener import Screener, _Parser, parse_rules, stoch_rsi
+
+
+def test_and_binds_tighter_than_or():
+    tree = _Parser("RSI14 < 30 or RSI14 > 70 and CLOSE > SMA200").parse()
+    assert tree[0] == "or"
+    assert tree[2][0] == "and"
+
+
+def test_parentheses_and_not():
+    tree = _Parser("not (RSI14 < 30 or RSI14 > 70)").parse()
+    assert tree[0] == "not"
+    assert tree[1][0] == "or"
+
+
+def test_indicator_defaults():
+    _, op, left, right = _Parser("CLOSE crosses_above day.SMA50").parse()
+    assert op == "crosses_above"
+    assert left == ("ind", "CLOSE", "day", "CLOSE", 1)
+    assert right == ("ind", "day.SMA50", "day", "SMA", 50)
+    assert _Parser("RSI < 30").parse()[2][4] == 14
+
+
+@pytest.mark.parametrize("expression", [
+    "RSI14 <",
+    "RSI14 30",
+    "(RSI14 < 30",
+    "RSI14 < 30 )",
+    "MACD < 0",
+    "RSI14 < 30 and",
+    "RSI14 ! 30",
+])
+def test_invalid_rules_raise(expression):
+    with pytest.raises(ValueError):
+        _Parser(expression).parse()
+
+
+def test_unsupported_timeframe_is_rejected_up_front():
+    with pytest.raises(ValueError, match="hour.RSI14"):
+        Screener({"Hourly": "hour.RSI14 < 30"})
+
+
+def test_parse_rules():
+    assert parse_rules(" Dip: RSI14 < 30 and CLOSE > SMA200 ; Cross: SMA50 crosses_above SMA200; ") == {
+        "Dip": "RSI14 < 30 and CLOSE > SMA200",
+        "Cross": "SMA50 crosses_above SMA200",
+    }
+    assert parse_rules("") == {}
+    with pytest.raises(ValueError):
+        parse_rules("RSI14 < 30")
+
+
+def test_screener_evaluates_comparisons_and_crosses():
+    closes = np.array([
+        [10, 10, 10, 10, 12],  # crosses above its 3 bar average on the last bar
+        [10, 11, 12, 13, 14],  # already above
+        [14, 13, 12, 11, 10],  # below
+    ], dtype=float)
+    screener = Screener({"Cross": "CLOSE crosses_above SMA3", "Above": "CLOSE > SMA3"})
+    result = screener.run(["A", "B", "C"], {"day": ([1, 2, 3, 4, 5], closes)})
+    assert result.evaluations["Cross"][1].tolist() == [True, False, False]
+    assert result.evaluations["Above"][1].tolist() == [True, True, False]
+    assert result.timestamp == 5
+    assert screener.direction("Above") == 1
+
+
+def test_stoch_rsi_is_undefined_until_the_window_is_full_of_rsi_values():
+    rng = np.random.default_rng(3)
+    closes = 100 + np.cumsum(rng.normal(0, 1, (3, 20)), axis=1)
+    # 20 bars give RSI from bar 14 on, a full 14 bar window of RSI values needs 28
+    assert np.isnan(stoch_rsi(closes, 14)).all()
+    screener = Screener({"Low": "STOCHRSI14 < 20"})
+    result = screener.run(["A", "B", "C"], {"day": (list(range(20)), closes)})
+    assert not result.evaluations["Low"][1].any()
+
+
+def test_stoch_rsi_of_flat_prices_is_undefined():
+    closes = np.full((1, 40), 50.0)
+    assert np.isnan(stoch_rsi(closes, 14)).all()
+
+
+def test_stoch_rsi_range():
+    rng = np.random.default_rng(5)
+    closes = 100 + np.cumsum(rng.normal(0, 1, (4, 60)), axis=1)
+    values = stoch_rsi(closes, 14)
+    assert np.isnan(values[:, :27]).all()
+    assert ((values[:, 27:] >= 0) & (values[:, 27:] <= 100)).all()
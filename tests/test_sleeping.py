@@ -0,0 +1,88 @@
+import asyncio
+import json
+from datetime import date, datetime
+import pytest
+import sleeping
+from sleeping import EASTERN, MarketScheduler, is_trading_day, market_holidays, early_closes, next_trigger, \
+    parse_schedule
+
+
+@pytest.mark.parametrize("day, trading", [
+    (date(2021, 12, 24), False),  # Christmas on a Saturday, observed the Friday before
+    (date(2026, 7, 3), False),  # Independence Day on a Saturday
+    (date(2027, 12, 31), True),  # New Year's Day 2028 on a Saturday is not observed
+    (date(2027, 12, 24), False),
+    (date(2022, 6, 20), False),  # Juneteenth on a Sunday, observed the Monday after
+    (date(2021, 6, 18), True),  # before Juneteenth was a market holiday
+    (date(2026, 4, 3), False),  # Good Friday
+    (date(2026, 11, 27), True),
+])
+def test_trading_days(day, trading):
+    assert is_trading_day(day) == trading
+
+
+def test_new_year_on_saturday_is_not_observed():
+    assert date(2027, 12, 31) not in market_holidays(2027)
+    assert date(2028, 1, 1) not in market_holidays(2028)
+
+
+@pytest.mark.parametrize("day", [date(2025, 11, 28), date(2026, 11, 27), date(2026, 12, 24), date(2025, 7, 3)])
+def test_early_closes(day):
+    assert day in early_closes(day.year)
+
+
+def test_close_trigger_on_early_close():
+    # Day after Thanksgiving closes at 1:00 PM, so close+5 runs at 13:05
+    at, name = next_trigger(datetime(2026, 11, 27, 9, 0, tzinfo=EASTERN), parse_schedule("close+5"))
+    assert (at, name) == (datetime(2026, 11, 27, 13, 5, tzinfo=EASTERN), "close+5")
+
+
+def test_trigger_skips_holiday():
+    at, _ = next_trigger(datetime(2026, 7, 2, 17, 0, tzinfo=EASTERN), parse_schedule("open+16"))
+    assert at == datetime(2026, 7, 6, 9, 46, tzinfo=EASTERN)
+
+
+def _scheduler_at(monkeypatch, tmp_path, now):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now.astimezone(tz)
+
+    monkeypatch.setattr(sleeping, "datetime", FrozenDatetime)
+    runs = []
+
+    async def func():
+        runs.append(now)
+
+    scheduler = MarketScheduler(func, schedule="open+16", catch_up_minutes=30,
+                                state_path=str(tmp_path / "schedule.json"))
+    # Last run the session before, so Monday's open+16 at 9:46 was missed
+    scheduler._save_last_run(datetime(2026, 10, 16, 9, 46, tzinfo=EASTERN))
+    return scheduler, runs
+
+
+def _saved_last_run(tmp_path) -> datetime:
+    with open(tmp_path / "schedule.json") as file:
+        return datetime.fromisoformat(json.load(file)["last_run"])
+
+
+def test_catch_up_recent_missed_run(monkeypatch, tmp_path):
+    scheduler, runs = _scheduler_at(monkeypatch, tmp_path, datetime(2026, 10, 19, 10, 0, tzinfo=EASTERN))
+    asyncio.run(scheduler._catch_up())
+    assert len(runs) == 1
+    assert _saved_last_run(tmp_path) == datetime(2026, 10, 19, 9, 46, tzinfo=EASTERN)
+
+
+def test_skip_stale_missed_run(monkeypatch, tmp_path):
+    scheduler, runs = _scheduler_at(monkeypatch, tmp_path, datetime(2026, 10, 19, 11, 0, tzinfo=EASTERN))
+    asyncio.run(scheduler._catch_up())
+    assert runs == []
+    # Marked as handled, so the next start does not consider it again
+    assert _saved_last_run(tmp_path) == datetime(2026, 10, 19, 9, 46, tzinfo=EASTERN)
+
+
+def test_nothing_missed(monkeypatch, tmp_path):
+    scheduler, runs = _scheduler_at(monkeypatch, tmp_path, datetime(2026, 10, 17, 12, 0, tzinfo=EASTERN))
+    asyncio.run(scheduler._catch_up())
+    assert runs == []
+    assert _saved_last_run(tmp_path) == datetime(2026, 10, 16, 9, 46, tzinfo=EASTERN)
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import numpy as np
+import dotenv
+from fetcher import get_scheduler
+from metrics import timed
+from nasdaq import all_in_one, NASDAQ_SCREENER_URL
+from tools import filter_tickers
+
+
+dotenv.load_dotenv()
+
+UNIVERSE_CACHE_DIR: str = os.getenv("UNIVERSE_CACHE_DIR", "data")
+# Hours a cached universe is used without asking the NASDAQ API again
+UNIVERSE_TTL_HOURS: float = float(os.getenv("UNIVERSE_TTL_HOURS", "12"))
+
+
+def _symbols_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, "universe.npy")
+
+
+def _meta_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, "universe.json")
+
+
+def rank_rows(rows: list) -> list:
+    """Filtered symbols from NASDAQ screener rows, largest market cap first"""
+    symbols = np.array([row["symbol"] for row in rows])
+    market_caps = np.array([float(row.get("marketCap") or 0) for row in rows])
+    ranked = symbols[np.argsort(-market_caps, kind="stable")].tolist()
+    return filter_tickers(ranked)
+
+
+def load_cached_universe(cache_dir: str = UNIVERSE_CACHE_DIR) -> tuple:
+    """Returns (symbols, meta) from the on-disk cache, ([], {}) when there is none"""
+    try:
+        symbols = np.load(_symbols_path(cache_dir), allow_pickle=False)
+        with open(_meta_path(cache_dir)) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return [], {}
+    return symbols.astype(str).tolist(), meta
+
+
+def save_universe(symbols: list, meta: dict, cache_dir: str = UNIVERSE_CACHE_DIR):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Fixed width byte strings, so loading is a single read with no parsing
+    np.save(_symbols_path(cache_dir), np.array(symbols, dtype="S"), allow_pickle=False)
+    with open(_meta_path(cache_dir), "w") as file:
+        json.dump(meta, file)
+
+
+def diff_universe(old: list, new: list) -> tuple:
+    """Returns (added, dropped) symbols between two universes, in ranked order"""
+    old_set, new_set = set(old), set(new)
+    return [s for s in new if s not in old_set], [s for s in old if s not in new_set]
+
+
+# Loads the ranked universe from cache, refreshing it from the NASDAQ API once the TTL has passed
+@timed("load_universe")
+async def load_universe(scheduler=None, cache_dir: str = UNIVERSE_CACHE_DIR,
+                        ttl_hours: float = UNIVERSE_TTL_HOURS, force: bool = False) -> list:
+    cached, meta = load_cached_universe(cache_dir)
+    if cached and not force and time.time() - meta.get("fetched_at", 0) < ttl_hours * 3600:
+        return cached
+
+    headers = {"User-Agent": "Mozilla/5.0"}  # NASDAQ API requires a user-agent
+    if cached:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    scheduler = scheduler or get_scheduler()
+    status, data, response_headers = await scheduler.get(NASDAQ_SCREENER_URL, headers=headers, with_headers=True)
+
+    if status == 304 and cached:
+        meta["fetched_at"] = time.time()
+        save_universe(cached, meta, cache_dir)
+        print(f"Ticker universe unchanged ({len(cached)} symbols)")
+        return cached
+
+    rows = (((data or {}).get("data") or {}).get("rows")) if status == 200 else None
+    if not rows:
+        print(f"Failed to fetch NASDAQ tickers: {status}")
+        if cached:
+            print(f"Using cached ticker universe ({len(cached)} symbols)")
+            return cached
+        print("Falling back to the built-in ticker list")
+        return filter_tickers(all_in_one())
+
+    symbols = rank_rows(rows)
+    added, dropped = diff_universe(cached, symbols)
+    if cached and (added or dropped):
+        print(f"Ticker universe changed: {len(added)} added {added[:20]}, {len(dropped)} dropped {dropped[:20]}")
+    save_universe(symbols, {
+        "fetched_at": time.time(),
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified"),
+        "added": added,
+        "dropped": dropped,
+    }, cache_dir)
+    return symbols